@@ -0,0 +1,165 @@
+import datetime
+import os.path
+import shutil
+import time
+from collections import Counter
+from tempfile import SpooledTemporaryFile
+from typing import Any
+
+from loguru import logger
+
+import config
+
+
+def clean_line(line: str) -> str:
+    return line.replace(r's\n', 's/n').replace(r'S\N', 's/n').replace('  ', ' ')
+
+
+def linhas_abertura(pdecred: dict[str, Any], uf: str, wdt_ini: str, wdt_fim: str) -> list[str]:
+    """
+    Registros 0000, 0001 e 0005 do arquivo de uma UF com transações.
+    """
+    return [
+        f"|0000|09|1|{uf}|{pdecred['empresa_cnpj']}|{pdecred['empresa_nome']}|{wdt_ini}|{wdt_fim}|1|"
+        f"{datetime.datetime.now().date().strftime('%Y%m')}|",
+        "|0001|1|",
+        f"|0005|{pdecred['empresa_nome']}|{pdecred['empresa_endereco']} {pdecred['empresa_numero']} "
+        f"{pdecred['empresa_compl']} {pdecred['empresa_bairro']}|{pdecred['empresa_cep']}|{pdecred['empresa_codmun']}|"
+        f"{pdecred['empresa_estado']}|{pdecred['responsavel']}|{pdecred['empresa_tel']}|{pdecred['empresa_email']}|",
+    ]
+
+
+def linhas_sem_transacoes(pdecred: dict[str, Any], uf: str, wdt_ini: str, wdt_fim: str) -> list[str]:
+    """
+    Arquivo completo (blocos 0, 1 e 9) de uma UF sem transações no período.
+    """
+    return [
+        f"|0000|09|4|{uf}|{pdecred['empresa_cnpj']}|{pdecred['empresa_nome']}|{wdt_ini}|{wdt_fim}|1|"
+        f"{datetime.datetime.now().date().strftime('%Y%m')}|",
+        '|0001|1|',
+        f"|0005|{pdecred['empresa_nome']}|{pdecred['empresa_endereco']}|{pdecred['empresa_cep']}|{pdecred['empresa_codmun']}|"
+        f"{pdecred['empresa_estado']}|{pdecred['responsavel']}|{pdecred['empresa_tel']}|{pdecred['empresa_email']}|",
+        '|0990|4|',
+        '|1001|0|',
+        '|1990|2|',
+        '|9001|1|',
+        '|9900|0000|1|',
+        '|9900|0001|1|',
+        '|9900|0005|1|',
+        '|9900|0990|1|',
+        '|9900|1001|1|',
+        '|9900|1990|1|',
+        '|9900|9001|1|',
+        '|9900|9990|1|',
+        '|9900|9999|1|',
+        '|9900|9900|10|',
+        '|9990|13|',
+        '|9999|19|',
+    ]
+
+
+def linhas_bloco9(contagem: dict[str, int]) -> list[str]:
+    """
+    Bloco 9 a partir da quantidade de linhas por registro dos blocos 0 e 1: 9001, os 9900
+    (9990 e 9999 primeiro, depois os demais registros em ordem, e por fim o próprio 9900), 9990 e 9999.
+    """
+    contagem = {**contagem, '9001': 1}
+    regs = sorted(reg for reg in contagem if reg != '9900')
+
+    qtd_9900 = 2 + len(regs) + 1
+    return [
+        '|9001|1|',
+        '|9900|9990|1|',
+        '|9900|9999|1|',
+        *(f'|9900|{reg}|{contagem[reg]}|' for reg in regs),
+        f'|9900|9900|{qtd_9900}|',
+        f'|9990|{qtd_9900 + 3}|',
+        f'|9999|{sum(contagem.values()) + qtd_9900 + 2}|',
+    ]
+
+
+class DimpEmitter:
+    """
+    Monta o arquivo DIMP da UF sem passar pelas tabelas tabela_dimp*: as linhas de cada tabela
+    são guardadas em arquivos temporários (em memória até `config.direct_spool_bytes`), com a contagem
+    por registro para o bloco 9, e o .txt é escrito de uma vez em `write`.
+    Com `audit`, as linhas também são repassadas ao StagingWriter.
+    """
+
+    # ordem das tabelas no arquivo; o 0990 entra entre o bloco 0 e o bloco 1
+    BLOCO_0 = ('tabela_dimp0100', 'tabela_dimp0200', 'tabela_dimp0300')
+    BLOCO_1 = ('tabela_dimp1100',)
+
+    def __init__(self, audit: Any | None = None, spool_bytes: int | None = None):
+        self.audit = audit
+        self.spool_bytes = spool_bytes or config.direct_spool_bytes
+
+        self._spools = {
+            table_name: SpooledTemporaryFile(max_size=self.spool_bytes, mode='w+')
+            for table_name in self.BLOCO_0 + self.BLOCO_1
+        }
+        self.contagem: Counter[str] = Counter()
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def add(self, table_name: str, row: tuple) -> None:
+        line = clean_line(row[8])
+        self.contagem[line[1:5]] += 1
+        self._spools[table_name].write(line + '\n')
+        if self.audit is not None:
+            self.audit.add(table_name, row)
+
+    def write(self, path: str, pdecred: dict[str, Any], uf: str, wdt_ini: str, wdt_fim: str) -> None:
+        start = time.perf_counter()
+
+        with open(path, 'w', encoding=config.output_encoding, buffering=config.export_buffer_bytes) as f:
+            if not self.contagem:
+                lines = [clean_line(line) for line in linhas_sem_transacoes(pdecred, uf, wdt_ini, wdt_fim)]
+                f.write(''.join(line + '\n' for line in lines))
+            else:
+                contagem = Counter(self.contagem)
+                abertura = [clean_line(line) for line in linhas_abertura(pdecred, uf, wdt_ini, wdt_fim)]
+                contagem.update(line[1:5] for line in abertura)
+                f.write(''.join(line + '\n' for line in abertura))
+
+                for table_name in self.BLOCO_0:
+                    self._copy(table_name, f)
+
+                qtd_lin_0 = sum(n for reg, n in contagem.items() if reg.startswith('0'))
+                f.write(f'|0990|{qtd_lin_0 + 1}|\n')
+                contagem['0990'] += 1
+
+                for table_name in self.BLOCO_1:
+                    self._copy(table_name, f)
+
+                f.write(''.join(line + '\n' for line in linhas_bloco9(contagem)))
+
+        self.bytes += os.path.getsize(path)
+
+        self.seconds += time.perf_counter() - start
+
+    def _copy(self, table_name: str, f) -> None:
+        spool = self._spools[table_name]
+        spool.seek(0)
+        shutil.copyfileobj(spool, f, 1024 ** 2)
+
+    def flush(self) -> None:
+        if self.audit is not None:
+            self.audit.flush()
+
+    def discard(self) -> None:
+        if self.audit is not None:
+            self.audit.discard()
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"Emissão direta: {sum(self.contagem.values())} linhas dos blocos 0 e 1, "
+            f"{self.bytes / 1024 ** 2:.1f} MB escritos em {self.seconds:.2f}s "
+            f"({dict(sorted(self.contagem.items()))})"
+        )
+        if self.audit is not None:
+            self.audit.log_stats()
+
+    def close(self) -> None:
+        for spool in self._spools.values():
+            spool.close()
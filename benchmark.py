@@ -0,0 +1,238 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from loguru import logger
+
+
+def bench_insert(sizes: list[int], verify: str) -> None:
+    """
+    Mede o tempo de gravação linha a linha com o InsertHandler para quantidades crescentes de linhas.
+    O tempo por linha deve se manter constante (custo linear no total de linhas).
+    """
+    import db
+    import gera_dimp_fd as g
+    from db import InsertHandler
+
+    table_name = 'tabela_dimp_bench'
+    with db.session() as session:
+        for size in sizes:
+            g.create_drop_table(session.cur, session.conn, table_name)
+
+            start = time.perf_counter()
+            for i in range(size):
+                InsertHandler(
+                    table_name=table_name,
+                    schema='siscof',
+                    values=[(1, 'DIMP_BENCH.txt', 1, '1115', '31', '12', '2024', i, f'|1115|{i}|', 35)],
+                    verify=verify
+                ).run_insert()
+            seconds = time.perf_counter() - start
+
+            logger.info(f"{size} linhas: {seconds:.2f}s ({seconds / size * 1e6:.0f} us/linha, verify={verify})")
+
+        session.cur.execute(f"DROP TABLE IF EXISTS siscof.{table_name}")
+        session.conn.commit()
+
+
+def bench_import(modules: list[str], repeat: int) -> None:
+    """
+    Mede o tempo de `import` de cada módulo em um interpretador novo (sem cache de módulos).
+    """
+    for module in modules:
+        code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+        times = [
+            float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout)
+            for _ in range(repeat)
+        ]
+        logger.info(
+            f"import {module}: mediana {statistics.median(times) * 1000:.0f} ms, "
+            f"mín {min(times) * 1000:.0f} ms, máx {max(times) * 1000:.0f} ms ({repeat} execuções)"
+        )
+
+
+def bench_log(queries: int, rows: int) -> None:
+    """
+    Compara, com o sink em INFO, o custo do log de resultados montado sempre (f-string + to_markdown,
+    como era feito no SelectHandler) com o log preguiçoso de `db.log_query_result`.
+    """
+    import os
+
+    import pandas as pd
+
+    import db
+
+    logger.remove()
+    logger.add(open(os.devnull, 'w'), level='INFO')
+    result = [
+        {'nsu': i, 'cod_aut': f'{i:06}', 'id_transac': f'ID{i}', 'valor': i * 1.5, 'hora': '120000'}
+        for i in range(rows)
+    ]
+    stmt = 'SELECT nsu, cod_aut, id_transac, valor, hora FROM siscof.vw_tbl_file'
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        logger.debug(f"Query executada:\n{stmt}\n{'-' * 30}\n{pd.DataFrame(result).to_markdown()}")
+    eager = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        db.log_query_result(stmt, result)
+    lazy = time.perf_counter() - start
+
+    logger.remove()
+    logger.add(sys.stdout, level='INFO')
+    logger.info(f"{queries} consultas de {rows} linhas em INFO: antes {eager:.3f}s, depois {lazy:.3f}s")
+
+
+def bench_staging(tables: list[str], repeat: int) -> None:
+    """
+    Copia as tabelas de staging já carregadas para uma versão HEAP (sem índices) e outra PARTITIONED
+    (partições UNLOGGED por uf, indexada após a carga) e compara o tempo de leitura de cada UF
+    na ordem de `sequencia`, como feito pelo gera_tabela_dimp_fd.
+    """
+    import db
+    import gera_dimp_fd as g
+
+    with db.session() as session:
+        cur, conn = session.cur, session.conn
+        for table_name in tables:
+            cur.execute(f"SELECT DISTINCT uf FROM siscof.{table_name} ORDER BY uf")
+            ufs = [r['uf'] for r in cur.fetchall()]
+
+            times: dict[str, dict[str, float]] = {}
+            for layout in ('HEAP', 'PARTITIONED'):
+                copy_name = f'{table_name}_bench_{layout.lower()}'
+                g.create_drop_table(cur, conn, copy_name, layout, ufs)
+                cur.execute(f"INSERT INTO siscof.{copy_name} SELECT * FROM siscof.{table_name}")
+                conn.commit()
+                if layout == 'PARTITIONED':
+                    g.index_staging_table(cur, conn, copy_name)
+
+                for uf in ufs:
+                    samples = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        cur.execute(f"SELECT linha FROM siscof.{copy_name} WHERE uf = %s ORDER BY sequencia, ordem", (uf,))
+                        cur.fetchall()
+                        samples.append(time.perf_counter() - start)
+                    times.setdefault(uf, {})[layout] = statistics.median(samples)
+
+                cur.execute(f"DROP TABLE siscof.{copy_name}")
+                conn.commit()
+
+            for uf, t in times.items():
+                logger.info(
+                    f"{table_name} uf {uf}: HEAP {t['HEAP'] * 1000:.1f} ms, "
+                    f"PARTITIONED {t['PARTITIONED'] * 1000:.1f} ms (mediana de {repeat})"
+                )
+
+
+def bench_shards(uf: int, shards: int) -> None:
+    """
+    Gera a UF de forma serial e com `shards` shards de lojas, emitindo direto para dois arquivos,
+    e verifica que os arquivos são idênticos byte a byte. As tabelas tabela_dimp* não são alteradas.
+    """
+    import filecmp
+
+    import config
+    import db
+    import gera_dimp_fd as g
+    from arquivo_dimp import DimpEmitter
+
+    g.config_logger()
+    # a UF é dividida mesmo abaixo do volume mínimo configurado
+    config.shard_min_transacoes = 0
+    with db.session() as session:
+        session.cur.execute('select cod_empresa, dt_dimp_ini from siscof.param_decred')
+        param_decred = session.cur.fetchall()[0]
+        g.materialize_elegiveis(*g.periodo(param_decred['dt_dimp_ini']))
+        g.J0100Index.create_cache_table(session.cur, session.conn)
+        pdecred = g.carrega_param_decred()
+
+        paths = []
+        for n in (1, shards):
+            d_info = g.DimpInfo(param_decred['cod_empresa'], uf, param_decred['dt_dimp_ini'], pdecred, DimpEmitter())
+            d_info.v_nome_arquivo = d_info.v_nome_arquivo.replace('.txt', f'_shards{n}.txt')
+            paths.append(f"{config.output_path}/{d_info.v_nome_arquivo}")
+
+            start = time.perf_counter()
+            with db.unit_of_work(f'UF {uf} ({n} shards)'):
+                g.gera_dimp_uf(d_info, shards=n)
+            logger.info(f"UF {uf}, {n} shard(s): {time.perf_counter() - start:.1f}s")
+
+    if filecmp.cmp(paths[0], paths[1], shallow=False):
+        logger.success(f"UF {uf}: arquivo com {shards} shards idêntico ao serial ({paths[1]})")
+    else:
+        logger.error(f"UF {uf}: arquivo com {shards} shards difere do serial ({paths[0]} x {paths[1]})")
+        sys.exit(1)
+
+
+def bench_uf(ufs: list[int], working_set: str | None = None) -> None:
+    """
+    Tempo de geração das UFs informadas no nível de log configurado em config.log_level.
+    Com `working_set`, sobrepõe config.working_set (OFF ou UF: a tabela da UF é criada e removida por run_uf).
+    """
+    import config
+    import db
+    import gera_dimp_fd as g
+
+    g.config_logger()
+    if working_set:
+        config.working_set = working_set
+    with db.session() as session:
+        session.cur.execute('select cod_empresa, dt_dimp_ini from siscof.param_decred')
+        param_decred = session.cur.fetchall()[0]
+        g.materialize_elegiveis(*g.periodo(param_decred['dt_dimp_ini']))
+        g.Fingerprints.create_table(session.cur, session.conn)
+        g.J0100Index.create_cache_table(session.cur, session.conn)
+
+    for uf in ufs:
+        seconds = g.run_uf(param_decred['cod_empresa'], uf, param_decred['dt_dimp_ini'])
+        logger.info(f"UF {uf}: {seconds:.1f}s (log_level={config.log_level}, working_set={config.working_set})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks do emissor DIMP')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    insert_parser = subparsers.add_parser('insert', help='custo de gravação do InsertHandler por quantidade de linhas')
+    insert_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000, 8000])
+    insert_parser.add_argument('--verify', choices=['OFF', 'COUNT', 'SAMPLE'], default='OFF')
+
+    import_parser = subparsers.add_parser('import', help='custo de importação dos módulos geradores')
+    import_parser.add_argument('--modules', nargs='+', default=['gera_dimp_fd', 'gera_tabela_dimp_fd'])
+    import_parser.add_argument('--repeat', type=int, default=5)
+
+    log_parser = subparsers.add_parser('log', help='custo do log de resultados com o sink em INFO')
+    log_parser.add_argument('--queries', type=int, default=1000)
+    log_parser.add_argument('--rows', type=int, default=50)
+
+    staging_parser = subparsers.add_parser('staging', help='leitura por UF das tabelas de staging, HEAP x PARTITIONED')
+    staging_parser.add_argument('--tables', nargs='+', default=['tabela_dimp1100', 'tabela_dimp0100', 'tabela_dimp0200'])
+    staging_parser.add_argument('--repeat', type=int, default=3)
+
+    shards_parser = subparsers.add_parser('shards', help='UF serial x shards de lojas, com verificação byte a byte')
+    shards_parser.add_argument('uf', type=int)
+    shards_parser.add_argument('--shards', type=int, default=4)
+
+    uf_parser = subparsers.add_parser('uf', help='tempo de geração de UFs no nível de log configurado')
+    uf_parser.add_argument('ufs', type=int, nargs='+')
+    uf_parser.add_argument('--working-set', choices=['OFF', 'UF'])
+
+    args = parser.parse_args()
+
+    if args.bench == 'insert':
+        bench_insert(args.sizes, args.verify)
+    elif args.bench == 'import':
+        bench_import(args.modules, args.repeat)
+    elif args.bench == 'log':
+        bench_log(args.queries, args.rows)
+    elif args.bench == 'staging':
+        bench_staging(args.tables, args.repeat)
+    elif args.bench == 'shards':
+        bench_shards(args.uf, args.shards)
+    elif args.bench == 'uf':
+        bench_uf(args.ufs, args.working_set)
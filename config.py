@@ -11,3 +11,77 @@ log_level: Literal["ERROR", "WARNING", "INFO", "DEBUG", "TRACE"] = "INFO"
 
 log_path = "logs/gera_dimp_fd.log"
 output_path = "output/"
+
+# gravação das tabelas tabela_dimp*: COPY FROM STDIN ou INSERT multi-linha (execute_values)
+staging_method: Literal["COPY", "VALUES"] = "COPY"
+staging_batch_size = 10000
+
+# estrutura das tabelas tabela_dimp*: "HEAP" (tabelas simples, sem índices) ou "PARTITIONED" (particionadas
+# por uf, partições UNLOGGED, com índices (uf, sequencia) e (uf, reg) e ANALYZE ao fim da carga)
+staging_layout: Literal["HEAP", "PARTITIONED"] = "HEAP"
+
+# verificação dos INSERTs do InsertHandler: "OFF" não relê nada, "COUNT" confere cur.rowcount,
+# "SAMPLE" relê apenas as linhas inseridas
+insert_verify: Literal["OFF", "COUNT", "SAMPLE"] = "OFF"
+
+# quantidade de linhas buscadas por vez nos cursores server-side
+stream_itersize = 20000
+
+# pool de conexões (por processo) e conexão separada, somente leitura, para as consultas de origem
+db_pool_min = 1
+db_pool_max = 4
+db_separate_read = True
+
+# log dos resultados das consultas (nível DEBUG/TRACE): limite de linhas e caracteres da tabela
+# e amostragem de 1 a cada `log_sample_rate` consultas
+log_result_max_rows = 50
+log_result_max_chars = 20000
+log_sample_rate = 1
+
+# executa também, para inspeção no log, as subconsultas das agregações (1100 e "tem transações")
+debug_subqueries = False
+
+# testes das variantes WHERE/HAVING no nível TRACE: "EXPLAIN" (linhas estimadas, sem executar),
+# "EXISTS" (só verifica se há retorno) ou "FETCH" (resultado completo); limite de variantes por
+# consulta e conexões do pool usadas em paralelo
+trace_test_mode: Literal["EXPLAIN", "EXISTS", "FETCH"] = "EXPLAIN"
+trace_test_max_variants = 16
+trace_test_workers = 1
+# resultados FETCH mantidos em memória para não repetir o teste da mesma consulta com os mesmos parâmetros
+trace_cache_fetch_max = 64
+
+# working set: materializa as transações do período em uma tabela UNLOGGED indexada, lida por todas
+# as consultas J* no lugar da view; "UF" cria uma tabela por UF, "ALL" uma única para todas as UFs
+working_set: Literal["OFF", "UF", "ALL"] = "OFF"
+
+# emissão do .txt: "STAGING" grava as tabelas tabela_dimp* e o arquivo é montado pelo gera_tabela_dimp_fd;
+# "DIRECT" monta o arquivo da UF no próprio gera_dimp_fd; "BOTH" emite direto e grava também as tabelas
+# (auditoria). Na emissão direta, as linhas ficam em memória até `direct_spool_bytes` por tabela
+emit_mode: Literal["STAGING", "DIRECT", "BOTH"] = "STAGING"
+direct_spool_bytes = 64 * 1024 ** 2
+
+# arquivos .txt: codificação (None usa a do sistema) e tamanho do buffer de escrita
+output_encoding: str | None = None
+export_buffer_bytes = 1024 ** 2
+
+# transação por UF: commit a cada `uf_commit_lojas` lojas (0 = um único commit ao fim da UF), com savepoint
+# em cada gravação; se a UF falhar, as suas linhas são removidas e ela é gerada de novo até `uf_retries` vezes.
+# Cada commit grava também o checkpoint da retomada por loja (--resume): com 0 não há checkpoint e a UF
+# interrompida é refeita inteira
+uf_commit_lojas = 500
+uf_retries = 1
+
+# geração incremental (--incremental): coluna de vw_tbl_file com a marca de atualização das transações, usada
+# na impressão digital de cada loja junto da quantidade e da soma (None usa o md5 dos id_transacao da loja)
+watermark_column: str | None = None
+
+# cache das linhas 0100/0300 já formatadas em siscof.dimp_cadastro_cache, por (uf, loja), invalidado pelo hash
+# dos campos de cadastro da origem; só as lojas com cadastro alterado passam pela consulta de formatação.
+# Desligado por padrão: o hash lê as mesmas linhas da origem que a formatação (numa falta, a origem é lida duas
+# vezes); ligue só se a economia medida no log (frente à formatação completa) compensar
+cadastro_cache = False
+
+# shards de lojas dentro de uma UF: UFs com pelo menos `shard_min_transacoes` transações no período têm as lojas
+# divididas em `shard_workers` faixas geradas em processos paralelos e juntadas na ordem serial (1 = desligado)
+shard_workers = 1
+shard_min_transacoes = 1_000_000
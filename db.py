@@ -0,0 +1,563 @@
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import itertools
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from itertools import combinations
+from typing import Callable, Literal, Iterator, Any
+
+import pandas as pd
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from loguru import logger
+from pypika import Table
+import config
+
+
+class ConnectionProvider:
+    """
+    Pool de conexões com o banco. Quando todas as conexões estão em uso, `connection()` aguarda
+    uma ser devolvida; o tempo de espera e o tempo de uso de cada conexão são acumulados como métricas.
+    """
+
+    def __init__(self, minconn: int | None = None, maxconn: int | None = None):
+        self.maxconn = maxconn or config.db_pool_max
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn or config.db_pool_min, self.maxconn, **config.DB_URL)
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._lock = threading.Lock()
+
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.held_seconds = 0.0
+
+        logger.success(f"pool de conexões: até {self.maxconn} conexões")
+
+    @contextlib.contextmanager
+    def connection(self, readonly: bool = False) -> Iterator[psycopg2.extensions.connection]:
+        start = time.perf_counter()
+        self._slots.acquire()
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        checkout = time.perf_counter()
+
+        try:
+            conn.readonly = readonly
+            yield conn
+        finally:
+            # o que não foi confirmado pelo chamador é descartado antes de devolver a conexão
+            if not conn.closed:
+                conn.rollback()
+            self._pool.putconn(conn)
+            self._slots.release()
+
+            with self._lock:
+                self.checkouts += 1
+                self.wait_seconds += checkout - start
+                self.max_wait_seconds = max(self.max_wait_seconds, checkout - start)
+                self.held_seconds += time.perf_counter() - checkout
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"pool de conexões: {self.checkouts} checkouts, "
+            f"espera total {self.wait_seconds:.3f}s (máx {self.max_wait_seconds:.3f}s), "
+            f"em uso {self.held_seconds:.1f}s"
+        )
+
+    def close(self) -> None:
+        self._pool.closeall()
+
+
+_provider: ConnectionProvider | None = None
+
+
+def provider() -> ConnectionProvider:
+    global _provider
+    if _provider is None:
+        _provider = ConnectionProvider()
+    return _provider
+
+
+def close_provider() -> None:
+    global _provider
+    if _provider is not None:
+        _provider.log_stats()
+        _provider.close()
+        _provider = None
+
+
+@dataclass
+class Session:
+    """
+    Conexões em uso pelo processo: `conn` para escrita e `read_conn` para as leituras que não dependem
+    do que foi escrito (pode ser a mesma conexão).
+    """
+    conn: psycopg2.extensions.connection
+    read_conn: psycopg2.extensions.connection
+
+    @functools.cached_property
+    def cur(self) -> psycopg2.extras.RealDictCursor:
+        return self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    @functools.cached_property
+    def read_cur(self) -> psycopg2.extras.RealDictCursor:
+        return self.read_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+_session: contextvars.ContextVar[Session] = contextvars.ContextVar('db_session')
+
+
+@contextlib.contextmanager
+def session(separate_read: bool | None = None) -> Iterator[Session]:
+    separate_read = config.db_separate_read if separate_read is None else separate_read
+
+    with contextlib.ExitStack() as stack:
+        conn = stack.enter_context(provider().connection())
+        read_conn = stack.enter_context(provider().connection(readonly=True)) if separate_read else conn
+
+        token = _session.set(Session(conn, read_conn))
+        try:
+            yield _session.get()
+        finally:
+            _session.reset(token)
+
+
+def current() -> Session:
+    try:
+        return _session.get()
+    except LookupError:
+        raise RuntimeError("Nenhuma sessão de banco ativa: use `with db.session():`") from None
+
+
+class UnitOfWork:
+    """
+    Transação de uma unidade de geração (uma UF) na conexão de escrita da sessão. Os escritores não fazem
+    commit enquanto ela está ativa: cada gravação roda em um savepoint e o commit acontece a cada
+    `commit_every` lojas (0 = apenas ao final) e na saída. Em caso de erro, desfaz o que não foi
+    confirmado e chama `cleanup` para remover o que já havia sido, deixando a unidade pronta para ser refeita.
+    """
+
+    def __init__(self, label: str, commit_every: int | None = None, cleanup: Callable[[], None] | None = None):
+        self.label = label
+        self.commit_every = config.uf_commit_lojas if commit_every is None else commit_every
+        self.cleanup = cleanup
+
+        self.lojas = 0
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def savepoint(self, name: str = 'gravacao') -> Iterator[None]:
+        cur = current().cur
+        cur.execute(f'SAVEPOINT {name}')
+        try:
+            yield
+        except Exception:
+            cur.execute(f'ROLLBACK TO SAVEPOINT {name}')
+            raise
+        else:
+            cur.execute(f'RELEASE SAVEPOINT {name}')
+
+    def commit(self) -> None:
+        start = time.perf_counter()
+        current().conn.commit()
+        self.commit_seconds += time.perf_counter() - start
+        self.commits += 1
+
+    def loja_done(self, flush: Callable[[], None]) -> None:
+        self.lojas += 1
+        if self.commit_every and self.lojas % self.commit_every == 0:
+            flush()
+            self.commit()
+
+    def log_stats(self) -> None:
+        seconds = time.perf_counter() - self.start
+        logger.info(
+            f"{self.label}: {self.commits} commits em {seconds:.1f}s ({self.commits / seconds if seconds else 0:.2f} commits/s), "
+            f"{self.commit_seconds:.2f}s em commit, {self.lojas} lojas"
+        )
+
+
+_unit_of_work: contextvars.ContextVar[UnitOfWork | None] = contextvars.ContextVar('db_unit_of_work', default=None)
+
+
+@contextlib.contextmanager
+def unit_of_work(
+        label: str,
+        commit_every: int | None = None,
+        cleanup: Callable[[], None] | None = None
+) -> Iterator[UnitOfWork]:
+    uow = UnitOfWork(label, commit_every, cleanup)
+    token = _unit_of_work.set(uow)
+    try:
+        yield uow
+        uow.commit()
+    except Exception as e:
+        current().conn.rollback()
+        logger.error(f"{uow.label}: transação desfeita após {uow.commits} commits\n{e}")
+        if uow.cleanup is not None:
+            uow.cleanup()
+            current().conn.commit()
+        raise
+    finally:
+        _unit_of_work.reset(token)
+        uow.log_stats()
+
+
+def current_unit() -> UnitOfWork | None:
+    return _unit_of_work.get()
+
+
+_query_log_counter = itertools.count()
+
+
+def render_result(r: list[dict], max_rows: int | None = None, max_chars: int | None = None) -> str:
+    max_rows = max_rows or config.log_result_max_rows
+    max_chars = max_chars or config.log_result_max_chars
+
+    text = pd.DataFrame(r[:max_rows]).to_markdown()
+    if len(r) > max_rows:
+        text += f"\n... ({len(r) - max_rows} linhas omitidas)"
+    if len(text) > max_chars:
+        text = text[:max_chars] + "\n... (truncado)"
+    return text
+
+
+def log_query_result(stmt: str, r: list[dict], level: str = 'DEBUG', depth: int = 1) -> None:
+    """
+    Registra a consulta e o seu resultado. A tabela só é montada se o nível estiver habilitado em algum sink,
+    limitada a `log_result_max_rows` linhas e `log_result_max_chars` caracteres, e apenas para
+    1 a cada `log_sample_rate` consultas.
+    """
+    if next(_query_log_counter) % config.log_sample_rate:
+        return
+    logger.opt(depth=depth + 1, lazy=True).log(
+        level, "Query executada:\n{}\n{}\n{}", lambda: stmt, lambda: '-' * 30, lambda: render_result(r)
+    )
+
+
+# resultados dos testes TRACE por (modo, consulta com os parâmetros já aplicados), válidos durante a execução:
+# com parâmetros de ligação, o texto da consulta é o mesmo para todas as UFs
+_trace_cache: dict[tuple[str, bytes], Any] = {}
+
+
+def trace_cache_put(key: tuple[str, bytes], result: Any) -> None:
+    """
+    Guarda o resultado de um teste TRACE; no modo FETCH, que guarda o resultado completo, só os
+    `config.trace_cache_fetch_max` mais recentes são mantidos.
+    """
+    _trace_cache[key] = result
+    if key[0] == 'FETCH':
+        fetch = [k for k in _trace_cache if k[0] == 'FETCH']
+        for k in fetch[:len(fetch) - config.trace_cache_fetch_max]:
+            del _trace_cache[k]
+
+
+def probe(
+        cur: psycopg2.extras.RealDictCursor,
+        stmt: str,
+        mode: Literal['EXPLAIN', 'EXISTS', 'FETCH'],
+        params: dict[str, Any] | None = None
+) -> Any:
+    """
+    Testa uma variante de consulta: `EXPLAIN` devolve as linhas estimadas pelo planejador,
+    `EXISTS` apenas se há retorno e `FETCH` o resultado completo.
+    """
+    if mode == 'EXPLAIN':
+        cur.execute('EXPLAIN (FORMAT JSON)\n' + stmt, params)
+        return cur.fetchone()['QUERY PLAN'][0]['Plan']['Plan Rows']
+    if mode == 'EXISTS':
+        cur.execute(f'SELECT EXISTS (\n{stmt}\n) tem_retorno', params)
+        return cur.fetchone()['tem_retorno']
+    cur.execute(stmt, params)
+    return cur.fetchall()
+
+
+def probe_pooled(
+        stmt: str,
+        mode: Literal['EXPLAIN', 'EXISTS', 'FETCH'],
+        params: dict[str, Any] | None = None
+) -> Any:
+    with provider().connection(readonly=True) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            return probe(cur, stmt, mode, params)
+
+
+class SelectHandler:
+
+    def __init__(
+            self,
+            select_: str,
+            from_: str,
+            where_: list[str] | None = None,
+            limit_: int | None = None,
+            group_by: str | None = None,
+            having_: list[str] | None = None,
+            order_by: str | None = None,
+            debug: bool = False,
+            selection_type: Literal['ALL', 'ONE'] = 'ALL',
+            log_level='DEBUG',
+            readonly: bool = False,
+            with_: dict[str, 'SelectHandler | UnionAll | str'] | None = None,
+            params: dict[str, Any] | None = None
+    ):
+        """
+        Apenas monta a consulta; nada é executado na construção. Com `debug=True`, a consulta
+        é executada em `run_debug()`, que deve ser chamado explicitamente.
+
+        Valores variáveis devem ir em `params` e ser referenciados nas condições como `%(nome)s`.
+        """
+
+        self.stmt_with = with_ or {}
+        self.stmt_select = select_
+        self.stmt_from = from_
+        self.stmt_limit = limit_
+        self.stmt_where_cndts = where_ or []
+        self.stmt_having_cndts = having_ or []
+        self.stmt_group_by = group_by
+        self.stmt_order_by = order_by
+
+        self.debug = debug
+        self.selection_type = selection_type
+        self.log_level = log_level
+        self.readonly = readonly
+        self.params = params
+
+    def make_where_having_stmt(self, where_cndts: list[str] | None = None, having_cndts: list[str] | None = None):
+        return (
+                (str('WITH ' + ',\n'.join(
+                    f'{name} AS (\n{query if isinstance(query, str) else query.stmt}\n)'
+                    for name, query in self.stmt_with.items()
+                ) + '\n') if self.stmt_with else '')
+                +
+                'SELECT ' + self.stmt_select
+                +
+                '\nFROM ' + self.stmt_from
+                +
+                (str(f'\nWHERE ' + '\t\nAND '.join(where_cndts))
+                 if where_cndts else '')
+                +
+                (str('\nGROUP BY ' + self.stmt_group_by)
+                 if self.stmt_group_by else '')
+                +
+                (str('\nHAVING ' + '\tAND '.join(having_cndts))
+                 if having_cndts else '')
+                +
+                (str('\nORDER BY ' + self.stmt_order_by)
+                 if self.stmt_order_by else '')
+                +
+                (str('\nLIMIT ' + str(self.stmt_limit))
+                 if self.stmt_limit else '')
+        )
+
+    @property
+    def stmt(self):
+        return self.make_where_having_stmt(self.stmt_where_cndts, self.stmt_having_cndts)
+
+    @property
+    def stmt_log(self) -> str:
+        return self.stmt + (f'\n-- params: {self.params}' if self.params else '')
+
+    def as_subquery(self, alias: str) -> str:
+        return f'({self.stmt}) {alias}'
+
+    def execute(self, cur: psycopg2.extras.RealDictCursor) -> None:
+        cur.execute(self.stmt, self.params)
+
+    def run_debug(self) -> None:
+        """
+        Executa, para inspeção, as CTEs marcadas com `debug=True` e depois a própria consulta, se marcada.
+        """
+        for query in self.stmt_with.values():
+            if not isinstance(query, str):
+                query.run_debug()
+        if self.debug:
+            self.run_select(log_level=self.log_level)
+
+    @property
+    def conn(self) -> psycopg2.extensions.connection:
+        return current().read_conn if self.readonly else current().conn
+
+    @property
+    def cur(self) -> psycopg2.extras.RealDictCursor:
+        return current().read_cur if self.readonly else current().cur
+
+    def gen_tests_stmts(self):
+        stmts = list[str]()
+
+        stmts.append(self.make_where_having_stmt([], []))
+        for r in range(len(self.stmt_where_cndts)):
+            for i in combinations(self.stmt_where_cndts, r):
+                stmts.append(self.make_where_having_stmt(list(i), self.stmt_having_cndts))
+        for r in range(len(self.stmt_having_cndts)):
+            for i in combinations(self.stmt_having_cndts, r):
+                stmts.append(self.make_where_having_stmt(self.stmt_where_cndts, list(i)))
+        return stmts
+
+    def __run_tests__(self):
+        if len(self.stmt_where_cndts) + len(self.stmt_having_cndts) == 0:
+            logger.opt(depth=1).error("Não há condições para testar")
+
+        mode = config.trace_test_mode
+        stmts = list(dict.fromkeys(self.gen_tests_stmts()))
+        if len(stmts) > config.trace_test_max_variants:
+            logger.opt(depth=2).warning(
+                f"{len(stmts)} variantes de teste, apenas as {config.trace_test_max_variants} primeiras serão testadas"
+            )
+            stmts = stmts[:config.trace_test_max_variants]
+
+        keys = {stmt: (mode, self.cur.mogrify(stmt, self.params)) for stmt in stmts}
+        results = {stmt: _trace_cache[keys[stmt]] for stmt in stmts if keys[stmt] in _trace_cache}
+        pending = [stmt for stmt in stmts if stmt not in results]
+        # variantes de consultas que leem a própria escrita não podem ir para outras conexões
+        if config.trace_test_workers > 1 and self.readonly and len(pending) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=config.trace_test_workers) as executor:
+                for stmt, result in zip(pending, executor.map(lambda s: probe_pooled(s, mode, self.params), pending)):
+                    results[stmt] = result
+        else:
+            for stmt in pending:
+                results[stmt] = probe(self.cur, stmt, mode, self.params)
+        for stmt in pending:
+            trace_cache_put(keys[stmt], results[stmt])
+
+        for stmt in stmts:
+            result = results[stmt]
+            if mode == 'FETCH':
+                log_query_result(stmt, result, level='TRACE', depth=2)
+            elif mode == 'EXISTS':
+                logger.opt(depth=2).trace(f"Query {'com' if result else 'sem'} retorno:\n{stmt}\n{'-' * 30}")
+            else:
+                logger.opt(depth=2).trace(f"Query com ~{result} linhas estimadas (EXPLAIN):\n{stmt}\n{'-' * 30}")
+
+    def run_select(self, selection_type: Literal["ONE", "ALL"] = None, log_level=None) -> list[dict] | dict:
+        log_level = log_level or self.log_level
+        selection_type = selection_type or self.selection_type
+        # print(f"selection_type: {selection_type}")
+
+        if log_level == 'TRACE':
+            self.__run_tests__()
+
+        cur = self.cur
+        try:
+            self.execute(cur)
+            r = cur.fetchall()
+        except Exception as e:
+            logger.opt(depth=1).error(f"Query executada:\n{self.stmt_log}\n{'-' * 30}\n{e}")
+            raise e
+        else:
+            if r:
+                log_query_result(self.stmt_log, r, depth=1)
+            if not r:
+                logger.opt(depth=1).warning(f"Query sem retorno:\n{self.stmt_log}\n{'-' * 30}\n")
+
+        if selection_type == 'ALL':
+            return r
+        elif selection_type == 'ONE':
+            return r[0]
+
+    def iter_select(self, itersize: int | None = None, log_level=None) -> Iterator[dict]:
+        """
+        Executa a consulta em um cursor server-side (nomeado) e entrega as linhas em lotes de `itersize`,
+        sem carregar o resultado inteiro em memória.
+        """
+        log_level = log_level or self.log_level
+        itersize = itersize or config.stream_itersize
+
+        if log_level == 'TRACE':
+            self.__run_tests__()
+
+        # o cursor só precisa sobreviver a commits quando a leitura divide a conexão com a escrita
+        named_cur = self.conn.cursor(
+            name=f'select_{uuid.uuid4().hex}',
+            cursor_factory=psycopg2.extras.RealDictCursor,
+            withhold=self.conn is current().conn
+        )
+        try:
+            self.execute(named_cur)
+            logger.opt(depth=1).debug(f"Query executada (cursor server-side):\n{self.stmt_log}\n{'-' * 30}")
+            while r := named_cur.fetchmany(itersize):
+                yield from r
+        except Exception as e:
+            logger.opt(depth=1).error(f"Query executada:\n{self.stmt_log}\n{'-' * 30}\n{e}")
+            raise e
+        finally:
+            named_cur.close()
+
+
+class InsertHandler:
+    def __init__(
+            self,
+            table_name: str,
+            schema: str,
+            values: list[tuple],
+            verify: Literal['OFF', 'COUNT', 'SAMPLE'] | None = None
+    ):
+        self.table_name = table_name
+        self.schema = schema
+        self.values = values
+        self.verify = verify or config.insert_verify
+
+    @property
+    def stmt(self) -> str:
+        stmt = str(Table(self.table_name, schema=self.schema).insert(*self.values))
+        if self.verify == 'SAMPLE':
+            stmt += ' RETURNING ctid'
+        return stmt
+
+    def run_insert(self):
+        conn, cur = current().conn, current().cur
+        uow = current_unit()
+        try:
+            # dentro de uma unidade de trabalho o commit fica com ela
+            with uow.savepoint() if uow else contextlib.nullcontext():
+                cur.execute(self.stmt)
+                if self.verify == 'COUNT' and cur.rowcount != len(self.values):
+                    raise RuntimeError(f"{cur.rowcount} linhas inseridas, esperado {len(self.values)}")
+                if self.verify == 'SAMPLE':
+                    ctids = [r['ctid'] for r in cur.fetchall()]
+                    cur.execute(f"SELECT * FROM {self.schema}.{self.table_name} WHERE ctid = ANY(%s::tid[])", (ctids,))
+                    r = cur.fetchall()
+                    if len(r) != len(self.values):
+                        raise RuntimeError(f"{len(r)} linhas lidas de volta, esperado {len(self.values)}")
+            if not uow:
+                conn.commit()
+        except Exception as e:
+            if not uow:
+                conn.rollback()
+            logger.opt(depth=1).error(f"Query executada:\n{self.stmt}\n{'-' * 30}\n{e}")
+            raise e
+        else:
+            logger.opt(depth=1).debug(f"Query executada:\n{self.stmt}\n{'-' * 30}")
+
+
+class UnionAll:
+    """
+    `UNION ALL` de consultas, para ser usado como CTE ou subconsulta sem executar as partes.
+    """
+
+    def __init__(self, *queries: SelectHandler):
+        self.queries = queries
+
+    @property
+    def stmt(self) -> str:
+        return '\nUNION ALL\n'.join(q.stmt for q in self.queries)
+
+    def as_subquery(self, alias: str) -> str:
+        return f'({self.stmt}) {alias}'
+
+    def run_debug(self) -> None:
+        for q in self.queries:
+            q.run_debug()
+
+
+def union_all(*queries: SelectHandler) -> UnionAll:
+    return UnionAll(*queries)
@@ -1,4 +1,14 @@
 import os
+import sys
 
-os.system(r"python gera_dimp_fd.py")
-os.system(r"python gera_tabela_dimp_fd.py")
\ No newline at end of file
+import config
+
+resume = ' --resume' if '--resume' in sys.argv[1:] else ''
+incremental = ' --incremental' if '--incremental' in sys.argv[1:] else ''
+
+status = os.system(r"python gera_dimp_fd.py" + resume + incremental)
+if status != 0:
+    sys.exit('gera_dimp_fd falhou: a dimp_tabela não é montada')
+if config.emit_mode == 'STAGING':
+    # na geração incremental as UFs alteradas saem da dimp_tabela e são montadas de novo pelo --resume
+    os.system(r"python gera_tabela_dimp_fd.py" + (' --resume' if resume or incremental else ''))
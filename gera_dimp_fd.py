@@ -1,10 +1,20 @@
+import argparse
+import atexit
+import bisect
+import concurrent.futures
 import contextlib
 import datetime
+import functools
+import io
+import multiprocessing
 import os.path
+import pickle
+import shutil
 import sys
+import tempfile
+import time
 from dataclasses import dataclass
-from itertools import combinations
-from typing import Literal, Any
+from typing import Literal, Any, NamedTuple, Iterator
 
 import pandas as pd
 import psycopg2
@@ -12,6 +22,9 @@ import psycopg2.extras
 from loguru import logger
 from pypika import Query, Table, Field, Order
 import config
+import db
+from db import SelectHandler
+from arquivo_dimp import DimpEmitter
 
 
 def config_logger() -> None:
@@ -26,165 +39,160 @@ def log_config_options() -> None:
     logger.info(f"config.log_path: {config.log_path}")
 
 
-config_logger()
-log_config_options()
+def debug_enabled() -> bool:
+    return config.log_level in ('DEBUG', 'TRACE')
 
-conn = psycopg2.connect(
-    **config.DB_URL
-)
-logger.success(f"connection: {conn.dsn}")
-cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-# tables = inspector.get_table_names()
-# logger.debug(f"Tables: {tables}")
+def log_diagnostics() -> None:
+    if not debug_enabled():
+        return
 
-cur.execute("SELECT * FROM siscof.param_decred")
-param_decred = pd.DataFrame(cur.fetchall())
+    cur = db.current().cur
 
-# cur.execute("SELECT * FROM siscof.vw_tbl_file")
-# vw_tbl_file = pd.DataFrame(cur.fetchall())
+    # tables = inspector.get_table_names()
+    # logger.debug(f"Tables: {tables}")
 
-cur.execute("SELECT * FROM siscof.dimp_pos_temp")
-dimp_pos_temp = pd.DataFrame(cur.fetchall())
+    cur.execute("SELECT * FROM siscof.param_decred")
+    param_decred = pd.DataFrame(cur.fetchall())
 
-logger.debug(f"param_decred:\n{param_decred.to_markdown()}\n{param_decred.to_dict()}")
-# logger.debug(f"vw_tbl_file:\n{vw_tbl_file.to_markdown()}\n{vw_tbl_file.to_dict()}")
-logger.debug(f"dimp_pos_temp:\n{dimp_pos_temp.to_markdown()}\n{dimp_pos_temp.to_dict()}")
+    # cur.execute("SELECT * FROM siscof.vw_tbl_file")
+    # vw_tbl_file = pd.DataFrame(cur.fetchall())
 
+    cur.execute("SELECT * FROM siscof.dimp_pos_temp")
+    dimp_pos_temp = pd.DataFrame(cur.fetchall())
 
-class SelectHandler:
+    logger.debug(f"param_decred:\n{param_decred.to_markdown()}\n{param_decred.to_dict()}")
+    # logger.debug(f"vw_tbl_file:\n{vw_tbl_file.to_markdown()}\n{vw_tbl_file.to_dict()}")
+    logger.debug(f"dimp_pos_temp:\n{dimp_pos_temp.to_markdown()}\n{dimp_pos_temp.to_dict()}")
 
-    def __init__(
-            self,
-            select_: str,
-            from_: str,
-            where_: list[str] | None = None,
-            limit_: int | None = None,
-            group_by: str | None = None,
-            having_: list[str] | None = None,
-            order_by: str | None = None,
-            debug: bool = False,
-            selection_type: Literal['ALL', 'ONE'] = 'ALL',
-            log_level='DEBUG'
-    ):
 
-        self.stmt_select = select_
-        self.stmt_from = from_
-        self.stmt_limit = limit_
-        self.stmt_where_cndts = where_ or []
-        self.stmt_having_cndts = having_ or []
-        self.stmt_group_by = group_by
-        self.stmt_order_by = order_by
+STAGING_TABLES = ('tabela_dimp1100', 'tabela_dimp0100', 'tabela_dimp0300', 'tabela_dimp0200')
+STAGING_COLUMNS = (
+    'instituicao', 'nome_tabela', 'bloco', 'reg', 'dia', 'mes', 'ano', 'sequencia', 'linha', 'uf', 'loja'
+)
 
-        self.debug = debug
-        self.selection_type = selection_type
-        self.log_level = log_level
 
-        if debug:
-            self.run_select(log_level=log_level)
+def copy_text_value(value: Any) -> str:
+    if value is None:
+        return r'\N'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
 
-    def make_where_having_stmt(self, where_cndts: list[str] | None = None, having_cndts: list[str] | None = None):
-        return (
-                'SELECT ' + self.stmt_select
-                +
-                '\nFROM ' + self.stmt_from
-                +
-                (str(f'\nWHERE ' + '\t\nAND '.join(where_cndts))
-                 if where_cndts else '')
-                +
-                (str('\nGROUP BY ' + self.stmt_group_by)
-                 if self.stmt_group_by else '')
-                +
-                (str('\nHAVING ' + '\tAND '.join(having_cndts))
-                 if having_cndts else '')
-                +
-                (str('\nORDER BY ' + self.stmt_order_by)
-                 if self.stmt_order_by else '')
-                +
-                (str('\nLIMIT ' + str(self.stmt_limit))
-                 if self.stmt_limit else '')
-        )
 
-    @property
-    def stmt(self):
-        return self.make_where_having_stmt(self.stmt_where_cndts, self.stmt_having_cndts)
-
-    def gen_tests_stmts(self):
-        stmts = list[str]()
-
-        stmts.append(self.make_where_having_stmt([], []))
-        for r in range(len(self.stmt_where_cndts)):
-            for i in combinations(self.stmt_where_cndts, r):
-                stmts.append(self.make_where_having_stmt(list(i), self.stmt_having_cndts))
-        for r in range(len(self.stmt_having_cndts)):
-            for i in combinations(self.stmt_having_cndts, r):
-                stmts.append(self.make_where_having_stmt(self.stmt_where_cndts, list(i)))
-        return stmts
-
-    def __run_tests__(self):
-        if len(self.stmt_where_cndts) + len(self.stmt_having_cndts) == 0:
-            logger.opt(depth=1).error("Não há condições para testar")
-        for stmt in self.gen_tests_stmts():
-            cur.execute(stmt)
-            r = cur.fetchall()
-            logger.opt(depth=2).trace(f"Query executada:\n{stmt}\n{'-' * 30}\n{pd.DataFrame(r).to_markdown()}")
-
-    def run_select(self, selection_type: Literal["ONE", "ALL"] = None, log_level=None) -> list[dict] | dict:
-        log_level = log_level or self.log_level
-        selection_type = selection_type or self.selection_type
-        # print(f"selection_type: {selection_type}")
-
-        if log_level == 'TRACE':
-            self.__run_tests__()
+class StagingWriter:
+    """
+    Acumula as linhas das tabelas tabela_dimp* em memória e grava em lote,
+    via COPY FROM STDIN (ou execute_values), a cada `batch_size` linhas por tabela.
+    """
 
+    def __init__(
+            self,
+            schema: str = 'siscof',
+            batch_size: int | None = None,
+            method: Literal['COPY', 'VALUES'] | None = None
+    ):
+        self.schema = schema
+        self.batch_size = batch_size or config.staging_batch_size
+        self.method = method or config.staging_method
+
+        self._buffers: dict[str, list[tuple]] = {}
+        self._rows: dict[str, int] = {}
+        self._seconds: dict[str, float] = {}
+
+    def add(self, table_name: str, row: tuple) -> None:
+        buffer = self._buffers.setdefault(table_name, [])
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self.flush_table(table_name)
+
+    def flush_table(self, table_name: str) -> None:
+        rows = self._buffers.get(table_name)
+        if not rows:
+            return
+
+        conn, cur = db.current().conn, db.current().cur
+        uow = db.current_unit()
+        start = time.perf_counter()
         try:
-            cur.execute(self.stmt)
-            r = cur.fetchall()
+            # dentro de uma unidade de trabalho o commit fica com ela
+            with uow.savepoint('staging') if uow else contextlib.nullcontext():
+                if self.method == 'COPY':
+                    buffer = io.StringIO()
+                    for row in rows:
+                        buffer.write('\t'.join(copy_text_value(v) for v in row) + '\n')
+                    buffer.seek(0)
+                    cur.copy_expert(
+                        f"COPY {self.schema}.{table_name} ({', '.join(STAGING_COLUMNS)}) FROM STDIN",
+                        buffer
+                    )
+                else:
+                    psycopg2.extras.execute_values(
+                        cur,
+                        f"INSERT INTO {self.schema}.{table_name} ({', '.join(STAGING_COLUMNS)}) VALUES %s",
+                        rows,
+                        page_size=self.batch_size
+                    )
+            if not uow:
+                conn.commit()
         except Exception as e:
-            logger.opt(depth=1).error(f"Query executada:\n{self.stmt}\n{'-' * 30}\n{e}")
+            if not uow:
+                conn.rollback()
+            logger.opt(depth=1).error(f"Falha ao gravar {len(rows)} linhas em {self.schema}.{table_name}\n{e}")
             raise e
-        else:
-            if r:
-                logger.opt(depth=1).debug(
-                    f"Query executada:\n{self.stmt}\n{'-' * 30}\n{pd.DataFrame(r).to_markdown()}")
-            if not r:
-                logger.opt(depth=1).warning(f"Query sem retorno:\n{self.stmt}\n{'-' * 30}\n")
-
-        if selection_type == 'ALL':
-            return r
-        elif selection_type == 'ONE':
-            return r[0]
 
+        self._seconds[table_name] = self._seconds.get(table_name, 0.0) + time.perf_counter() - start
+        self._rows[table_name] = self._rows.get(table_name, 0) + len(rows)
+        logger.opt(depth=1).debug(f"{len(rows)} linhas gravadas em {self.schema}.{table_name} ({self.method})")
+        rows.clear()
+
+    def flush(self) -> None:
+        for table_name in list(self._buffers):
+            self.flush_table(table_name)
+
+    def discard(self) -> None:
+        for rows in self._buffers.values():
+            rows.clear()
+
+    def log_stats(self) -> None:
+        for table_name, rows in sorted(self._rows.items()):
+            seconds = self._seconds[table_name]
+            logger.info(
+                f"{self.schema}.{table_name}: {rows} linhas em {seconds:.2f}s "
+                f"({rows / seconds if seconds else 0:.0f} linhas/s)"
+            )
 
-class InsertHandler:
-    def __init__(self, table_name: str, schema: str, values: list[tuple]):
-        self.table_name = table_name
-        self.schema = schema
-        self.values = values
+    def close(self) -> None:
+        # ao fim normal cada UF já gravou as suas linhas; as que sobram são de uma UF interrompida (ex.: Ctrl-C),
+        # cujo lote foi desfeito, e gravá-las fora da unidade de trabalho deixaria no staging linhas sem checkpoint
+        pendentes = sum(len(rows) for rows in self._buffers.values())
+        if pendentes:
+            logger.warning(f"{pendentes} linhas de staging não confirmadas descartadas no encerramento")
+            self.discard()
+        self.log_stats()
 
-    @property
-    def stmt(self) -> str:
-        return str(Table(self.table_name, schema=self.schema).insert(*self.values))
 
-    def run_insert(self):
-        try:
-            cur.execute(self.stmt)
-            conn.commit()
-        except Exception as e:
-            logger.opt(depth=1).error(f"Query executada:\n{self.stmt}\n{'-' * 30}\n{e}")
-            raise e
-        else:
-            cur.execute(f"SELECT * FROM {self.schema}.{self.table_name}")
-            r = cur.fetchall()
-            logger.opt(depth=1).debug(f"Query executada:\n{self.stmt}\n{'-' * 30}")#\n{pd.DataFrame(r).to_markdown()}")
+staging = StagingWriter()
 
 
 class DimpInfo:
-    def __init__(self, p_instituicao: int, p_cod_estado: int, p_data: int, pdecred: dict[str, Any]):
+    def __init__(
+            self,
+            p_instituicao: int,
+            p_cod_estado: int,
+            p_data: int,
+            pdecred: dict[str, Any],
+            writer: StagingWriter | DimpEmitter = staging
+    ):
         self.p_instituicao = p_instituicao
         self.p_cod_estado = p_cod_estado
         self.p_data = p_data
         self.pdecred = pdecred
+        self.writer = writer
 
         self.dt_ini = str(p_data)
         self.dt_fim = int(str(pd.to_datetime(self.dt_ini, format='%Y%m%d').to_period('M').end_time)[:10].replace('-', ''))
@@ -200,26 +208,51 @@ class DimpInfo:
             f'wdt_fim: {self.wdt_fim}, p_ano: {self.p_ano}, p_mes: {self.p_mes}, p_dia: {self.p_dia}'
         )
 
-        self.p_uf = SelectHandler('simbolo', 'siscof.ESTADO', [f'cod_estado={p_cod_estado}']).run_select('ONE')[
-                   'simbolo'][:2]
+        estado = SelectHandler('simbolo, pais', 'siscof.ESTADO', [f'cod_estado={p_cod_estado}']).run_select('ONE')
+        self.p_uf = estado['simbolo'][:2]
+        self.pais = estado['pais']
         self.wqtd_lin_0 = 0
         self.v_nome_arquivo = f"DIMP_{self.p_uf:02}_{self.dt_fim}.txt"
         self.wreg = None
         self.wbloco = 1
         self.wqtd_lin_0 = 0
         self.wqtd_lin_1 = 1
+        # loja do 1100 em geração, gravada na coluna `loja` do staging (None no 1001 e no 1990)
         self.wloja = None
+        self.terminais_0200: set[str] = set()
+
+        # origem das transações: a view ou o working set materializado (ver materialize_working_set)
+        self.source = 'siscof.vw_tbl_file'
 
 @dataclass
 class LoopData:
     index: int
-    len: int
+    len: int | None
+
+
+# pessoa física só compõe o 1100 quando o total da loja no período (por psp e UF) atinge os dois limites
+PF_VALOR_MINIMO = 3375
+PF_QTD_MINIMA = 30
+
+ELEGIVEIS_TABLE = 'siscof.dimp_elegiveis'
+
+# condição para uma linha da base do J1100 compor o 1100 da UF
+ELEGIVEL_1100 = "elegivel AND uf = %(uf)s"
 
 
 class J1100Child:
-    def __init__(self, data: dict[str, Any], dinfo: DimpInfo):
+    def __init__(
+            self,
+            data: dict[str, Any],
+            dinfo: DimpInfo,
+            rows_1110: list[dict[str, Any]] | None = None,
+            ultimo: bool = True
+    ):
         self._data = data
         self._dinfo = dinfo
+        self.rows_1110 = rows_1110 or []
+        # último 1100 (um por psp) da loja: depois dele os 1110 e 1115 da loja não são emitidos de novo
+        self.ultimo = ultimo
 
     def __getitem__(self, item):
         return self._data[item]
@@ -232,126 +265,255 @@ class J1100Child:
         line = f'|1100|{wiparc}|{self["loja"]}|0|0|{self._dinfo.wdt_ini}|{self._dinfo.wdt_fim}|' \
                f'{str(self["valor"]).replace(".", ",")}|{self["qtd"]}|'
         wreg = '1100'
-        InsertHandler(
-            table_name='tabela_dimp1100',
-            schema='siscof',
-            values=[(1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg,
-                     str(self._dinfo.dt_fim)[6:8], str(self._dinfo.dt_fim)[4:6],
-                     str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_1, line,
-                     self._dinfo.p_cod_estado)]
-        ).run_insert()
+        self._dinfo.writer.add(
+            'tabela_dimp1100',
+            (1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg,
+             str(self._dinfo.dt_fim)[6:8], str(self._dinfo.dt_fim)[4:6],
+             str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_1, line,
+             self._dinfo.p_cod_estado, self._dinfo.wloja)
+        )
 
 
 class J1100:
-    def __init__(self, dimp_info: DimpInfo):
+    """
+    Registros 1100 e 1110 das lojas elegíveis da UF em uma única agregação por GROUPING SETS:
+    (loja, psp) com as linhas elegíveis dá o 1100 e (loja, terminal, data_operacao) com todas
+    as linhas da loja dá o 1110. O resultado vem ordenado por loja (collation C, a ordem das comparações
+    de str em Python), com o 1100 antes do 1110.
+    """
+
+    def __init__(self, dimp_info: DimpInfo, lojas: list[str] | None = None):
         self.dinfo = dimp_info
-        self._data: list[dict[str, Any]] = self.query.run_select()
+        # restrição às lojas de um shard (ver gera_shards)
+        self.lojas = lojas
+        query = self.query
+        query.run_debug()
+        self._rows: Iterator[dict[str, Any]] = query.iter_select()
+        self._children = self._lojas()
+        self._first = next(self._children, None)
+
+    @property
+    def params(self) -> dict[str, Any]:
+        return {
+            'uf': self.dinfo.p_uf, 'wdt_ini': self.dinfo.wdt_ini, 'wdt_fim': self.dinfo.wdt_fim, 'lojas': self.lojas
+        }
 
     @property
     def query(self) -> SelectHandler:
         return SelectHandler(
-            select_='loja,psp,Sum(VALOR) VALOR,Sum(QTD) QTD, uf',
-            from_='(' + (
-                    SelectHandler(
-                        debug=True, log_level='DEBUG',
-
-                        select_='vw.loja,vw.psp,vw.tipo_pessoa,Sum(vw.valor_operacao) VALOR,Count(1) QTD, vw.uf uf',
-                        from_='siscof.vw_tbl_file vw'
-                              ' inner join siscof.dimp_pos_temp as dpt on vw.terminal = dpt.terminal',
-                        where_=[
-                            # f't.instituicao = {p_instituicao}',
-                            # 't.loja = e.loja',
-                            # 't.instituicao = e.instituicao',
-                            "vw.tipo_pessoa = 'J'",
-                            f"vw.data_operacao >= to_date('{self.dinfo.wdt_ini}','yyyymmdd')",
-                            f"vw.data_operacao <= to_date('{self.dinfo.wdt_fim}','yyyymmdd')",
-                            f"vw.uf = '{self.dinfo.p_uf}'"
-                        ],
-                        group_by='vw.loja,vw.psp,vw.tipo_pessoa, vw.uf'
-                    ).stmt
-                    +
-                    ' UNION ALL '
-                    +
-                    SelectHandler(
-                        debug=True, log_level='DEBUG',
-
-                        select_='vw.loja,vw.psp,vw.tipo_pessoa,Sum(vw.valor_operacao) VALOR,Count(1) QTD, vw.uf uf',
-                        from_='siscof.vw_tbl_file vw'
-                              ' inner join siscof.dimp_pos_temp as dpt on vw.terminal = dpt.terminal',
-                        where_=[
-                            # f't.instituicao = {p_instituicao}',
-                            # 't.loja = e.loja',
-                            # 't.instituicao = e.instituicao',
-                            "vw.tipo_pessoa = 'F'",
-                            f"vw.data_operacao >= to_date('{self.dinfo.wdt_ini}','yyyymmdd')",
-                            f"vw.data_operacao <= to_date('{self.dinfo.wdt_fim}','yyyymmdd')",
-                            f"vw.uf = '{self.dinfo.p_uf}'"
-                        ],
-                        having_=[
-                            'Sum(vw.valor_operacao) >= 3375',
-                            'Count(1) >= 30'
-                        ],
-                        group_by='vw.loja,vw.psp,vw.tipo_pessoa, vw.uf'
-                    ).stmt
-            ) + ') l',
-            group_by='loja, psp, uf',
-            having_=[f"uf = '{self.dinfo.p_uf}'"],
-            selection_type='ALL', log_level='DEBUG'
+            select_='loja, psp, terminal COD_MCAPT, data_operacao DT_OP,'
+                    'GROUPING(terminal, data_operacao) NIVEL,'
+                    'CASE WHEN GROUPING(terminal, data_operacao) = 0 THEN Sum(valor_operacao)'
+                    f' ELSE Sum(valor_operacao) FILTER (WHERE {ELEGIVEL_1100}) END VALOR,'
+                    'CASE WHEN GROUPING(terminal, data_operacao) = 0 THEN Count(1)'
+                    f' ELSE Count(1) FILTER (WHERE {ELEGIVEL_1100}) END QTD',
+            with_={'base': SelectHandler(
+                debug=config.debug_subqueries, log_level='DEBUG',
+
+                select_='vw.loja, vw.psp, vw.tipo_pessoa, vw.uf, vw.terminal, vw.data_operacao, vw.valor_operacao,'
+                        'el.loja IS NOT NULL ELEGIVEL',
+                from_=f'{self.dinfo.source} vw'
+                      ' inner join siscof.dimp_pos_temp as dpt on vw.terminal = dpt.terminal'
+                      f' left join {ELEGIVEIS_TABLE} el on el.loja = vw.loja and el.psp IS NOT DISTINCT FROM vw.psp'
+                      ' and el.tipo_pessoa = vw.tipo_pessoa and el.uf = vw.uf',
+                where_=[
+                    # f't.instituicao = {p_instituicao}',
+                    "vw.data_operacao >= to_date(%(wdt_ini)s,'yyyymmdd')",
+                    "vw.data_operacao <= to_date(%(wdt_fim)s,'yyyymmdd')",
+                    f"vw.loja IN (SELECT e.loja FROM {ELEGIVEIS_TABLE} e WHERE e.uf = %(uf)s)"
+                ] + (["vw.loja = ANY(%(lojas)s)"] if self.lojas else []),
+                params=self.params, readonly=True
+            )},
+            from_='base',
+            group_by='GROUPING SETS ((loja, psp), (loja, terminal, data_operacao))',
+            having_=[f'GROUPING(terminal, data_operacao) = 0 OR Count(1) FILTER (WHERE {ELEGIVEL_1100}) > 0'],
+            # collation C: a mesma ordem de loja do J1115Stream, do shards_uf e das comparações em Python
+            # 1110 em (terminal, data_operacao) na mesma ordem do J1115Stream, que entrega os 1115 por 1110
+            order_by='loja COLLATE "C", NIVEL DESC, psp, terminal COLLATE "C", data_operacao',
+            params=self.params,
+            selection_type='ALL', log_level='DEBUG', readonly=True
         )
 
+    def _lojas(self) -> Iterator[J1100Child]:
+        """
+        Agrupa o fluxo por loja; lojas sem 1100 (nenhuma linha elegível) são descartadas.
+        """
+        loja, rows_1100, rows_1110 = None, [], []
+        for row in self._rows:
+            if row['loja'] != loja:
+                for i, r in enumerate(rows_1100):
+                    yield J1100Child(r, self.dinfo, rows_1110, ultimo=i == len(rows_1100) - 1)
+                loja, rows_1100, rows_1110 = row['loja'], [], []
+            (rows_1100 if row['nivel'] else rows_1110).append(row)
+        for i, r in enumerate(rows_1100):
+            yield J1100Child(r, self.dinfo, rows_1110, ultimo=i == len(rows_1100) - 1)
+
+    @property
+    def tem_transacoes(self) -> bool:
+        return self._first is not None
+
     def __iter__(self):
         self._iter_index = -1
         return self
 
     def __next__(self) -> tuple[J1100Child, LoopData]:
         self._iter_index += 1
-        if self._iter_index < len(self._data):
-            return (
-                J1100Child(self._data[self._iter_index], self.dinfo),
-                LoopData(
-                    index=self._iter_index,
-                    len=len(self._data)
-                )
+        child = self._first if self._iter_index == 0 else next(self._children, None)
+        if child is None:
+            raise StopIteration
+        return (
+            child,
+            LoopData(
+                index=self._iter_index,
+                len=None
             )
-        raise StopIteration
+        )
 
 
 class J0100Child:
-    def __init__(self, data: dict[str, Any], dinfo: DimpInfo):
+    def __init__(self, data: dict[str, Any], dinfo: DimpInfo, linhas: tuple[str, str] | None = None):
         self._data = data
         self._dinfo = dinfo
+        # linhas 0100 e 0300 já formatadas, vindas do cache de cadastro (ver J0100Index)
+        self._linhas = linhas
 
     def __getitem__(self, item):
         return self._data[item]
 
-    def create_line(self) -> None:
+    @property
+    def linha_0100(self) -> str:
+        if self._linhas:
+            return self._linhas[0]
+
         for key, value in self._data.items():
             if value is None:
                 self._data[key] = ''
 
-        line = f"|0100" + f"|{self['cod_estab']}" \
+        return f"|0100" + f"|{self['cod_estab']}" \
                           f"|{self['cnpj']}|{self['cpf']}|{self['n_fant']}|{self['ende']}|{self['cep']}" \
                           f"|{self['cod_mun']}|{self['uf']}|{self['nome_resp']}|{self['fone_cont']}|{self['email_cont']}" \
                           f"|{self['dt_creden']}|{self['psp']}|"
 
+    @property
+    def linha_0300(self) -> str:
+        if self._linhas:
+            return self._linhas[1]
+
+        return f"|0300|{self['cod_estab']}-IP|{self['cnpj']}|{self['n_fant']}|{self['ende']}|{self['cep']}" \
+               f"|{self['cod_mun']}|{self['uf']}|{self['nome_resp']}|{self['fone_cont']}|{self['email_cont']}|"
+
+    def create_line(self) -> None:
+        line = self.linha_0100
+
         wloja = self['cod_estab']
         wreg = '0100'
-        InsertHandler(
-            table_name='tabela_dimp0100',
-            schema='siscof',
-            values=[(1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg,
-                     str(self._dinfo.dt_fim)[6:8], str(self._dinfo.dt_fim)[4:6],
-                     str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_0, line,
-                     self._dinfo.p_cod_estado)]
-        ).run_insert()
+        self._dinfo.writer.add(
+            'tabela_dimp0100',
+            (1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg,
+             str(self._dinfo.dt_fim)[6:8], str(self._dinfo.dt_fim)[4:6],
+             str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_0, line,
+             self._dinfo.p_cod_estado, self._dinfo.wloja)
+        )
         # f.write(line + '\n')
 
 
-class J0100:
-    def __init__(self, dimp_info: DimpInfo, j1100: J1100Child):
+class J0100Row(NamedTuple):
+    cod_estab: str
+    cnpj: str | None
+    cpf: str | None
+    n_fant: str | None
+    ende: str | None
+    cep: str | None
+    cod_mun: Any
+    uf: str | None
+    nome_resp: str | None
+    fone_cont: str | None
+    email_cont: str | None
+    dt_creden: str | None
+    psp: str | None
+
+
+class J0100Cadastro(NamedTuple):
+    psp: str | None
+    linha_0100: str
+    linha_0300: str
+
+
+CADASTRO_CACHE_TABLE = 'siscof.dimp_cadastro_cache'
+# último tempo medido da formatação do cadastro de todas as lojas da UF, referência da economia do cache
+CADASTRO_TEMPO_TABLE = 'siscof.dimp_cadastro_tempo'
+
+# campos de origem das linhas 0100/0300; o hash deles invalida o cache de cadastro da loja
+CADASTRO_CONTEUDO = """
+    DISTINCT vw.loja COD_ESTAB,
+    ROW(vw.tipo_pessoa, vw.cnpj_adqui, vw.cpf_cnpj, vw.nome_fantasia, vw.nm_logradouro, vw.nu_logradouro,
+        vw.nm_complemento, vw.nm_bairro, vw.cep, vw.cod_ibge, vw.uf, vw.nm_pessoa, vw.fone_cont, vw.email_cont,
+        Coalesce(cast(vw.data_credenciamento as DATE), CURRENT_DATE), vw.psp)::text conteudo
+"""
+
+
+class J0100Index:
+    """
+    Cadastro 0100 de todos os estabelecimentos da UF, carregado com uma única consulta
+    e indexado por loja, já com as linhas 0100 e 0300 formatadas.
+    Com `config.cadastro_cache`, as linhas ficam em siscof.dimp_cadastro_cache por (uf, loja) entre as
+    execuções: uma consulta calcula o hash dos campos de origem de cada loja e só as lojas com hash
+    diferente do gravado (faltas) passam pela consulta de formatação e são gravadas de novo.
+    O hash lê as mesmas linhas de origem da formatação (não há cadastro de lojas fora da vw_tbl_file): o cache
+    evita a formatação e a transferência das linhas das lojas sem alteração, não a leitura da origem.
+    Toda formatação da UF inteira (sem cache ou sem nenhum acerto) grava o seu tempo em siscof.dimp_cadastro_tempo;
+    com acertos, a economia registrada no log é esse tempo menos o hash e a formatação das faltas desta execução.
+    """
+
+    def __init__(self, dimp_info: DimpInfo, lojas: list[str] | None = None):
         self.dinfo = dimp_info
-        self.j1100 = j1100
-        self._data: list[dict[str, Any]] = self.query.run_select()
+        self.lojas = lojas
+        self.hits = 0
+        self.misses = 0
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.hash_seconds = 0.0
+        self.format_seconds = 0.0
+
+        self._index: dict[str, list[J0100Cadastro]] = {}
+        self._faltas: list[str] | None = None
+
+        hashes: dict[str, str] = {}
+        if config.cadastro_cache:
+            start = time.perf_counter()
+            hashes = {r['cod_estab']: r['hash'] for r in self.hash_query.run_select()}
+            for loja, (h, cadastro) in self._load_cache(list(hashes)).items():
+                if h == hashes[loja]:
+                    self._index[loja] = cadastro
+            self._faltas = [loja for loja in hashes if loja not in self._index]
+            self.hash_seconds = time.perf_counter() - start
+            self.cache_hits, self.cache_misses = len(self._index), len(self._faltas)
+
+        start = time.perf_counter()
+        if self._faltas is None or self._faltas:
+            for r in self.query.run_select():
+                j0100 = J0100Child(J0100Row(**r)._asdict(), self.dinfo)
+                self._index.setdefault(r['cod_estab'], []).append(
+                    J0100Cadastro(r['psp'], j0100.linha_0100, j0100.linha_0300)
+                )
+        self.format_seconds = time.perf_counter() - start
+
+        if self._faltas:
+            self._save_cache({loja: hashes[loja] for loja in self._faltas if loja in self._index})
+
+        # referência só para o índice da UF inteira (não para o de um shard)
+        self.referencia: dict[str, Any] | None = None
+        if self.lojas is None:
+            if self.cache_hits:
+                self.referencia = self._load_referencia()
+            else:
+                self._save_referencia()
+
+        logger.info(
+            f"Índice 0100 ({self.dinfo.p_uf}): {len(self._index)} lojas, {self.rows} linhas, "
+            f"~{self.approx_bytes / 1024 ** 2:.1f} MB"
+        )
 
     @property
     def query(self) -> SelectHandler:
@@ -381,18 +543,152 @@ class J0100:
                 To_Char(Coalesce(cast(vw.data_credenciamento as DATE),Date_trunc('day', CURRENT_TIMESTAMP(0))),'YYYYMMDD') DT_CREDEN,
                 vw.psp
             """,
-            from_='siscof.vw_tbl_file vw'
+            from_=f'{self.dinfo.source} vw'
                   ' inner join siscof.dimp_pos_temp as dpt'
                   ' on vw.terminal = dpt.terminal',
             where_=[
                 # f"e.instituicao = '{p_instituicao}'",
-                f"vw.loja = '{self.j1100['loja']}'",
-                f"vw.uf = '{self.dinfo.p_uf}'"
-            ],
+                "vw.uf = %(uf)s",
+                f"vw.loja IN (SELECT e.loja FROM {ELEGIVEIS_TABLE} e WHERE e.uf = %(uf)s)"
+            ] + (["vw.loja = ANY(%(lojas)s)"] if self._faltas or self.lojas else []),
+            order_by='COD_ESTAB',
+            params={'uf': self.dinfo.p_uf, 'lojas': self._faltas or self.lojas},
+
+            selection_type='ALL', log_level=config.log_level, readonly=True
+        )
+
+    @property
+    def hash_query(self) -> SelectHandler:
+        return SelectHandler(
+            select_="COD_ESTAB, md5(string_agg(conteudo, '#' ORDER BY conteudo)) HASH",
+            with_={'cadastro': SelectHandler(
+                select_=CADASTRO_CONTEUDO,
+                from_=f'{self.dinfo.source} vw'
+                      ' inner join siscof.dimp_pos_temp as dpt'
+                      ' on vw.terminal = dpt.terminal',
+                where_=[
+                    "vw.uf = %(uf)s",
+                    f"vw.loja IN (SELECT e.loja FROM {ELEGIVEIS_TABLE} e WHERE e.uf = %(uf)s)"
+                ] + (["vw.loja = ANY(%(lojas)s)"] if self.lojas else []),
+                params={'uf': self.dinfo.p_uf, 'lojas': self.lojas}, readonly=True
+            )},
+            from_='cadastro',
+            group_by='COD_ESTAB',
+            params={'uf': self.dinfo.p_uf, 'lojas': self.lojas},
+            selection_type='ALL', log_level=config.log_level, readonly=True
+        )
+
+    @staticmethod
+    def create_cache_table(cur, conn) -> None:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {CADASTRO_CACHE_TABLE} (
+                uf varchar(2),
+                loja varchar,
+                hash text,
+                psp text[],
+                linhas_0100 text[],
+                linhas_0300 text[],
+                atualizado timestamp DEFAULT now(),
+                PRIMARY KEY (uf, loja)
+            )""")
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {CADASTRO_TEMPO_TABLE} (
+                uf varchar(2) PRIMARY KEY,
+                segundos numeric,
+                atualizado timestamp DEFAULT now()
+            )""")
+        conn.commit()
+
+    def _load_referencia(self) -> dict[str, Any] | None:
+        cur = db.current().cur
+        cur.execute(f"SELECT segundos, atualizado FROM {CADASTRO_TEMPO_TABLE} WHERE uf = %s", (self.dinfo.p_uf,))
+        return cur.fetchone()
+
+    def _save_referencia(self) -> None:
+        cur = db.current().cur
+        cur.execute(
+            f"INSERT INTO {CADASTRO_TEMPO_TABLE} (uf, segundos) VALUES (%s, %s)"
+            " ON CONFLICT (uf) DO UPDATE SET segundos = EXCLUDED.segundos, atualizado = now()",
+            (self.dinfo.p_uf, self.format_seconds)
+        )
 
-            selection_type='ALL', log_level=config.log_level
+    def _load_cache(self, lojas: list[str]) -> dict[str, tuple[str, list[J0100Cadastro]]]:
+        cur = db.current().cur
+        cur.execute(
+            f"SELECT loja, hash, psp, linhas_0100, linhas_0300 FROM {CADASTRO_CACHE_TABLE}"
+            " WHERE uf = %s AND loja = ANY(%s)",
+            (self.dinfo.p_uf, lojas)
+        )
+        return {
+            r['loja']: (r['hash'], [J0100Cadastro(*c) for c in zip(r['psp'], r['linhas_0100'], r['linhas_0300'])])
+            for r in cur.fetchall()
+        }
+
+    def _save_cache(self, hashes: dict[str, str]) -> None:
+        cur = db.current().cur
+        psycopg2.extras.execute_values(
+            cur,
+            f"INSERT INTO {CADASTRO_CACHE_TABLE} (uf, loja, hash, psp, linhas_0100, linhas_0300) VALUES %s"
+            " ON CONFLICT (uf, loja) DO UPDATE SET hash = EXCLUDED.hash, psp = EXCLUDED.psp,"
+            " linhas_0100 = EXCLUDED.linhas_0100, linhas_0300 = EXCLUDED.linhas_0300, atualizado = now()",
+            [
+                (self.dinfo.p_uf, loja, h, *(list(c) for c in zip(*self._index[loja])))
+                for loja, h in hashes.items()
+            ]
+        )
+
+    @property
+    def rows(self) -> int:
+        return sum(len(v) for v in self._index.values())
+
+    @property
+    def approx_bytes(self) -> int:
+        return sys.getsizeof(self._index) + sum(
+            sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r)
+            for v in self._index.values() for r in v
+        )
+
+    def get(self, loja: str) -> list[J0100Cadastro]:
+        rows = self._index.get(loja)
+        if rows is None:
+            self.misses += 1
+            return []
+        self.hits += 1
+        return rows
+
+    def log_stats(self) -> None:
+        total = self.hits + self.misses
+        logger.info(
+            f"Índice 0100 ({self.dinfo.p_uf}): {self.hits} acertos, {self.misses} faltas "
+            f"({self.hits / total if total else 0:.1%} de acerto)"
+        )
+        if not config.cadastro_cache:
+            return
+
+        # economia frente ao último tempo medido da formatação da UF inteira (negativa quando o hash custa mais)
+        if self.referencia:
+            economia = (
+                f"{float(self.referencia['segundos']) - self.hash_seconds - self.format_seconds:.2f}s "
+                f"(formatação completa de {float(self.referencia['segundos']):.2f}s em "
+                f"{self.referencia['atualizado']:%d/%m/%Y %H:%M})"
+            )
+        elif self.lojas is None and not self.cache_hits:
+            economia = 'nenhuma (sem acertos; tempo da formatação completa gravado como referência)'
+        else:
+            economia = 'sem referência medida'
+        logger.info(
+            f"Cache de cadastro 0100/0300 ({self.dinfo.p_uf}): {self.cache_hits} acertos, "
+            f"{self.cache_misses} faltas; hash {self.hash_seconds:.2f}s, "
+            f"formatação das faltas {self.format_seconds:.2f}s; economia {economia}"
         )
 
+
+class J0100:
+    def __init__(self, dimp_info: DimpInfo, j1100: J1100Child, index: J0100Index):
+        self.dinfo = dimp_info
+        self.j1100 = j1100
+        self._data: list[J0100Cadastro] = index.get(self.j1100['loja'])
+
     def __iter__(self):
         self._iter_index = -1
         return self
@@ -400,8 +696,12 @@ class J0100:
     def __next__(self) -> tuple[J0100Child, LoopData]:
         self._iter_index += 1
         if self._iter_index < len(self._data):
+            cadastro = self._data[self._iter_index]
             return (
-                J0100Child(self._data[self._iter_index], self.dinfo),
+                J0100Child(
+                    {'cod_estab': self.j1100['loja'], 'psp': cadastro.psp}, self.dinfo,
+                    (cadastro.linha_0100, cadastro.linha_0300)
+                ),
                 LoopData(
                     index=self._iter_index,
                     len=len(self._data)
@@ -431,47 +731,24 @@ class J1110Child:
                f"|{self['qtd']}" \
                f"|{self._dinfo.pdecred['empresa_cnpj']}|"
 
-        InsertHandler(
-            table_name='tabela_dimp1100',
-            schema='siscof',
-            values=[(1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg,
-                     str(self._dinfo.dt_fim)[6:8], str(self._dinfo.dt_fim)[4:6],
-                     str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_1, line,
-                     self._dinfo.p_cod_estado)]
-        ).run_insert()
+        self._dinfo.writer.add(
+            'tabela_dimp1100',
+            (1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg,
+             str(self._dinfo.dt_fim)[6:8], str(self._dinfo.dt_fim)[4:6],
+             str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_1, line,
+             self._dinfo.p_cod_estado, self._dinfo.wloja)
+        )
 
 
 class J1110:
+    """
+    Registros 1110 da loja do 1100, já agregados pela consulta do J1100.
+    """
+
     def __init__(self, dimp_info: DimpInfo, j1100: J1100Child):
         self.dinfo = dimp_info
         self.j1100 = j1100
-        self._data: list[dict[str, Any]] = self.query.run_select()
-
-    @property
-    def query(self) -> SelectHandler:
-        return SelectHandler(
-            select_=
-            'vw.terminal COD_MCAPT,'
-            'vw.data_operacao DT_OP,'
-            'Sum(vw.valor_operacao) VALOR,'
-            'Count(1) QTD',
-            from_='siscof.vw_tbl_file vw'
-                  ' inner join siscof.dimp_pos_temp as dpt on vw.terminal=dpt.terminal',
-            where_=[
-                # f"instituicao = '{p_instituicao}'",
-                f"vw.loja = '{self.j1100['loja']}'",
-                f"vw.data_operacao >= to_date('{self.dinfo.wdt_ini}','yyyymmdd')",
-                f"vw.data_operacao <= to_date('{self.dinfo.wdt_fim}','yyyymmdd')"
-            ],
-            group_by='vw.terminal,'
-                     'vw.data_operacao',
-            order_by='vw.terminal',
-            # having_=[
-            #    f"vw.data_operacao >= to_date('{wdt_ini}','yyyymmdd')",
-            #    f"vw.data_operacao <= to_date('{wdt_fim}','yyyymmdd')"
-            # ],
-            selection_type='ALL', log_level=config.log_level
-        )
+        self._data: list[dict[str, Any]] = self.j1100.rows_1110
 
     def __iter__(self):
         self._iter_index = -1
@@ -481,7 +758,7 @@ class J1110:
         self._iter_index += 1
         if self._iter_index < len(self._data):
             return (
-                J1110Child(self._data[self._iter_index], self.dinfo),
+                J1110Child(dict(self._data[self._iter_index]), self.dinfo),
                 LoopData(
                     index=self._iter_index,
                     len=len(self._data)
@@ -501,41 +778,69 @@ class J0200Child:
     def create_line(self) -> None:
         wreg = '0200'
         line = self['linha']
-        InsertHandler(
-            table_name='tabela_dimp0200',
-            schema='siscof',
-            values=[(1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg, str(self._dinfo.dt_fim)[6:8],
-                     str(self._dinfo.dt_fim)[4:6],
-                     str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_0, line, self._dinfo.p_cod_estado)]
-        ).run_insert()
+        self._dinfo.writer.add(
+            'tabela_dimp0200',
+            (1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg, str(self._dinfo.dt_fim)[6:8],
+             str(self._dinfo.dt_fim)[4:6],
+             str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_0, line, self._dinfo.p_cod_estado,
+             self._dinfo.wloja)
+        )
 
 
-class J0200:
-    def __init__(self, dimp_info: DimpInfo, j1110: J1110Child):
-        self.dinfo = dimp_info
-        self.j1110 = j1110
-        self._data: list[dict[str, Any]] = self.query.run_select()
+class J0200Catalogue:
+    """
+    Linhas 0200 de todos os terminais de dimp_pos_temp, carregadas uma única vez por execução.
+    """
+
+    def __init__(self):
+        self._lines: dict[str, list[str]] = {}
+        for r in self.query.run_select():
+            self._lines.setdefault(str(r['terminal']).rstrip(), []).append(r['linha'])
+        logger.info(f"Catálogo 0200: {len(self._lines)} terminais")
 
     @property
     def query(self) -> SelectHandler:
         return SelectHandler(
             select_=
             "DISTINCT "
+            "terminal, "
             "case when forma_captura = 'POS' then "
             "('|0200|'||RTrim(terminal)||'|'||RTrim(terminal)||'|'||'3'||'|'||RTrim('0')||'|'||''||'|' ) "
             "else "
             "('|0200|'||RTrim(terminal)||'|'||RTrim(terminal)||'|'||forma_captura||'|'||RTrim('0')||'|'||''||'|' )"
             "end linha ",
             from_='siscof.dimp_pos_temp',
-            where_=[
-                # f"acquirer_id = '{p_instituicao}'",
-                f"terminal = '{self.j1110['cod_mcapt']}'"
-            ],
-            order_by='1',
+            # where_=[f"acquirer_id = '{p_instituicao}'"],
+            order_by='1, 2',
 
-            selection_type='ALL', log_level=config.log_level
+            selection_type='ALL', log_level=config.log_level, readonly=True
         )
 
+    def get(self, terminal: str) -> list[str]:
+        return self._lines.get(str(terminal).rstrip(), [])
+
+
+@functools.cache
+def j0200_catalogue() -> J0200Catalogue:
+    return J0200Catalogue()
+
+
+class J0200:
+    """
+    Linhas 0200 do terminal do 1110, apenas na primeira vez em que o terminal aparece na UF.
+    """
+
+    def __init__(self, dimp_info: DimpInfo, j1110: J1110Child):
+        self.dinfo = dimp_info
+        self.j1110 = j1110
+
+        terminal = str(self.j1110['cod_mcapt']).rstrip()
+        if terminal in self.dinfo.terminais_0200:
+            self._data: list[dict[str, Any]] = []
+        else:
+            self.dinfo.terminais_0200.add(terminal)
+            self._data = [{'linha': linha} for linha in j0200_catalogue().get(terminal)]
+
     def __iter__(self):
         self._iter_index = -1
         return self
@@ -580,26 +885,55 @@ class J1115Child:
                f"|" \
                f"||"
 
-        InsertHandler(
-            table_name='tabela_dimp1100',
-            schema='siscof',
-            values=[(1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg, str(self._dinfo.dt_fim)[6:8],
-                     str(self._dinfo.dt_fim)[4:6],
-                     str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_1, line, self._dinfo.p_cod_estado)]
-        ).run_insert()
+        self._dinfo.writer.add(
+            'tabela_dimp1100',
+            (1, self._dinfo.v_nome_arquivo, self._dinfo.wbloco, wreg, str(self._dinfo.dt_fim)[6:8],
+             str(self._dinfo.dt_fim)[4:6],
+             str(self._dinfo.dt_fim)[0:4], self._dinfo.wqtd_lin_1, line, self._dinfo.p_cod_estado,
+             self._dinfo.wloja)
+        )
+
 
+class J1115Stream:
+    """
+    Lê, em uma única consulta por UF, todas as transações 1115 do período ordenadas por
+    loja, terminal, data_operacao e hora, através de um cursor server-side.
+    As transações são entregues por (loja, terminal, data_operacao), na mesma ordem em que o J1100 percorre
+    as lojas e os 1110: em memória fica só o grupo do 1110 atual, além do lote do cursor (`itersize`).
+    A exceção são as lojas com mais de um 1100 (um por psp), cujos 1110 e 1115 se repetem em cada 1100:
+    os grupos dessas lojas ficam guardados até o último 1100 da loja.
+    Com `lojas`, apenas as lojas de um shard (ver gera_shards) ou as lidas da origem na geração
+    incremental (ver Reuso) são lidas.
+    """
 
-class J1115:
-    def __init__(self, dimp_info: DimpInfo, j1100: J1100Child, j1110: J1110Child):
+    def __init__(
+            self,
+            dimp_info: DimpInfo,
+            itersize: int | None = None,
+            lojas: list[str] | None = None
+    ):
         self.dinfo = dimp_info
-        self.j1100 = j1100
-        self.j1110 = j1110
-        self._data: list[dict[str, Any]] = self.query.run_select()
+        self.itersize = itersize or config.stream_itersize
+        self.lojas = lojas
+
+        self._rows: Iterator[dict[str, Any]] = self.query.iter_select(self.itersize)
+        self._pending: dict[str, Any] | None = None
+
+        self._loja = None
+        self._ultima = None
+        self._linhas_loja = 0
+        self._guardados: dict[tuple, list[dict[str, Any]]] = {}
+
+        self.max_grupo = 0
+        self.max_guardadas = 0
 
     @property
     def query(self) -> SelectHandler:
         return SelectHandler(
-            select_="nsu,"
+            select_="vw.loja,"
+                    "vw.terminal,"
+                    "vw.data_operacao,"
+                    "nsu,"
                     "autorizacao                         COD_AUT,"
                     "id_transacao                        ID_TRANSAC,"
                     "Case transacao_split When 'N' Then 0 Else 1 End     IND_SPLIT,"
@@ -609,15 +943,93 @@ class J1115:
                     "Case forma_pagamento When '1' Then 1 When '2' Then 2 Else 1 End NAT_OPER ,"
                     "NULL                                GEO,"
                     "valor_operacao                      VALOR",
-            from_='siscof.vw_tbl_file',
+            from_=f'{self.dinfo.source} vw',
             where_=[
                 # f"instituicao = '{p_instituicao}'",
-                f"loja = '{self.j1100['loja']}'",
-                f"data_operacao = '{self.j1110['dt_op']}'",
-                f"terminal = '{self.j1110['cod_mcapt']}'"
-            ],
+                "vw.data_operacao >= to_date(%(wdt_ini)s,'yyyymmdd')",
+                "vw.data_operacao <= to_date(%(wdt_fim)s,'yyyymmdd')",
+                "vw.terminal IN (SELECT dpt.terminal FROM siscof.dimp_pos_temp dpt)",
+                f"vw.loja IN (SELECT e.loja FROM {ELEGIVEIS_TABLE} e WHERE e.uf = %(uf)s)"
+            ] + (["vw.loja = ANY(%(lojas)s)"] if self.lojas else []),
+            # collation C, como no J1100: `loja` compara as lojas em Python, byte a byte
+            order_by='vw.loja COLLATE "C", vw.terminal COLLATE "C", vw.data_operacao, vw.hora_transacao',
+            params={'uf': self.dinfo.p_uf, 'wdt_ini': self.dinfo.wdt_ini, 'wdt_fim': self.dinfo.wdt_fim,
+                    'lojas': self.lojas},
+            selection_type='ALL', log_level=config.log_level, readonly=True
+        )
+
+    def _next_row(self) -> dict[str, Any] | None:
+        if self._pending is not None:
+            row, self._pending = self._pending, None
+            return row
+        return next(self._rows, None)
+
+    def _troca_loja(self, loja: str | None) -> None:
+        if self._loja is not None and not self._linhas_loja:
+            logger.warning(f"Nenhuma transação 1115 para a loja {self._loja} ({self.dinfo.p_uf})")
+        self._loja = loja
+        self._linhas_loja = 0
+        self._guardados = {}
+
+    def grupo(self, loja: str, terminal: str, data_operacao: Any, guardar: bool = False) -> list[dict[str, Any]]:
+        """
+        Transações de (loja, terminal, data_operacao), lidas do fluxo até a primeira linha de um grupo posterior,
+        que fica pendente para o próximo pedido. Linhas de grupos anteriores ao pedido (lojas sem 1100) são
+        descartadas. Com `guardar`, o grupo fica disponível para os próximos 1100 da mesma loja.
+        Se o fluxo ou os pedidos saírem da ordem de loja, a geração é interrompida em vez de descartar transações.
+        """
+        if loja != self._loja:
+            if self._loja is not None and loja < self._loja:
+                raise RuntimeError(
+                    f"J1115Stream ({self.dinfo.p_uf}): loja {loja} pedida depois da loja {self._loja}"
+                )
+            self._troca_loja(loja)
 
-            selection_type='ALL', log_level=config.log_level
+        chave = (terminal, data_operacao)
+        if chave in self._guardados:
+            return self._guardados[chave] if guardar else self._guardados.pop(chave)
+
+        linhas = []
+        while (row := self._next_row()) is not None:
+            if self._ultima is not None and row['loja'] < self._ultima:
+                raise RuntimeError(
+                    f"J1115Stream ({self.dinfo.p_uf}): loja {row['loja']} depois da loja {self._ultima} no fluxo"
+                )
+            self._ultima = row['loja']
+
+            posicao = (row['loja'], row['terminal'], row['data_operacao'])
+            if posicao > (loja, *chave):
+                self._pending = row
+                break
+            if posicao == (loja, *chave):
+                linhas.append(row)
+
+        self._linhas_loja += len(linhas)
+        self.max_grupo = max(self.max_grupo, len(linhas))
+        if guardar:
+            self._guardados[chave] = linhas
+            self.max_guardadas = max(self.max_guardadas, sum(len(g) for g in self._guardados.values()))
+        return linhas
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"J1115Stream ({self.dinfo.p_uf}): maior grupo (terminal, data) com {self.max_grupo} linhas, "
+            f"maior loja com mais de um 1100 guardada com {self.max_guardadas} linhas"
+        )
+
+    def close(self) -> None:
+        self._troca_loja(None)
+        self._rows.close()
+        self.log_stats()
+
+
+class J1115:
+    def __init__(self, dimp_info: DimpInfo, j1100: J1100Child, j1110: J1110Child, stream: J1115Stream):
+        self.dinfo = dimp_info
+        self.j1100 = j1100
+        self.j1110 = j1110
+        self._data: list[dict[str, Any]] = stream.grupo(
+            self.j1100['loja'], self.j1110['cod_mcapt'], self.j1110['dt_op'], guardar=not self.j1100.ultimo
         )
 
     def __iter__(self):
@@ -637,7 +1049,21 @@ class J1115:
         raise StopIteration
 
 
-def create_drop_table(cur, conn, table_name):
+def create_drop_table(
+        cur,
+        conn,
+        table_name,
+        layout: Literal['HEAP', 'PARTITIONED'] | None = None,
+        ufs: list[int | str] = ()
+):
+    """
+    Recria a tabela de staging. Com `layout='PARTITIONED'`, a tabela é particionada por lista de `uf`,
+    com uma partição UNLOGGED por UF de `ufs` (e uma DEFAULT); os índices ficam para depois da carga
+    (ver index_staging_table). A coluna `ordem`, preenchida pela sequência na gravação, desempata as linhas
+    de mesma `sequencia` (1001 e o primeiro 1100, o 0100 repetido de psp 'N') na ordem em que foram geradas.
+    """
+    layout = layout or config.staging_layout
+
     cur.execute(f"DROP TABLE IF EXISTS siscof.{table_name};")
     cur.execute(f"""
         CREATE TABLE IF NOT EXISTS siscof.{table_name} (
@@ -650,49 +1076,418 @@ def create_drop_table(cur, conn, table_name):
             ano varchar,
             sequencia integer,
             linha varchar,
-            uf varchar(2)
-        )""")
+            uf varchar(2),
+            loja varchar,
+            ordem bigserial
+        )""" + (" PARTITION BY LIST (uf)" if layout == 'PARTITIONED' else ""))
+
+    if layout == 'PARTITIONED':
+        for uf in ufs:
+            cur.execute(
+                f"CREATE UNLOGGED TABLE siscof.{table_name}_{uf} PARTITION OF siscof.{table_name} FOR VALUES IN (%s)",
+                (str(uf),)
+            )
+        cur.execute(f"CREATE UNLOGGED TABLE siscof.{table_name}_default PARTITION OF siscof.{table_name} DEFAULT")
+    conn.commit()
+
+
+def index_staging_table(cur, conn, table_name) -> None:
+    """
+    Índices (uf, sequencia, ordem) e (uf, reg) e estatísticas, criados depois da carga da tabela de staging.
+    """
+    start = time.perf_counter()
+    cur.execute(
+        f"CREATE INDEX IF NOT EXISTS {table_name}_uf_sequencia_idx ON siscof.{table_name} (uf, sequencia, ordem)"
+    )
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_uf_reg_idx ON siscof.{table_name} (uf, reg)")
+    cur.execute(f"ANALYZE siscof.{table_name}")
+    conn.commit()
+    logger.info(f"siscof.{table_name} indexada e analisada em {time.perf_counter() - start:.1f}s")
+
+
+def periodo(p_data: int) -> tuple[str, str]:
+    dt_ini = str(p_data)
+    dt_fim = str(pd.to_datetime(dt_ini, format='%Y%m%d').to_period('M').end_time)[:10].replace('-', '')
+    return dt_ini, dt_fim
+
+
+def working_set_table(p_cod_estado: int | None = None) -> str:
+    return 'siscof.dimp_ws' if p_cod_estado is None else f'siscof.dimp_ws_{p_cod_estado}'
+
+
+def materialize_working_set(table: str, wdt_ini: str, wdt_fim: str, p_uf: str | None = None) -> None:
+    """
+    Copia para uma tabela UNLOGGED as linhas de vw_tbl_file do período com terminal em dimp_pos_temp,
+    restritas às lojas da UF quando `p_uf` é informada (ou de todas as UFs), indexada e analisada,
+    para que as consultas J* não reexpandam a view a cada execução.
+    """
+    conn, cur = db.current().conn, db.current().cur
+    params = {'wdt_ini': wdt_ini, 'wdt_fim': wdt_fim, 'uf': p_uf}
+    start = time.perf_counter()
+
+    try:
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+        cur.execute(f"""
+            CREATE UNLOGGED TABLE {table} AS
+            SELECT vw.*
+              FROM siscof.vw_tbl_file vw
+             WHERE vw.data_operacao >= to_date(%(wdt_ini)s,'yyyymmdd')
+               AND vw.data_operacao <= to_date(%(wdt_fim)s,'yyyymmdd')
+               AND vw.terminal IN (SELECT dpt.terminal FROM siscof.dimp_pos_temp dpt)
+        """ + ("" if p_uf is None else """
+               AND vw.loja IN (
+                   SELECT u.loja FROM siscof.vw_tbl_file u
+                    WHERE u.uf = %(uf)s
+                      AND u.data_operacao >= to_date(%(wdt_ini)s,'yyyymmdd')
+                      AND u.data_operacao <= to_date(%(wdt_fim)s,'yyyymmdd'))
+        """), params)
+        rows = cur.rowcount
+        cur.execute(f"CREATE INDEX ON {table} (uf, loja, terminal, data_operacao)")
+        cur.execute(f"ANALYZE {table}")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Falha ao materializar {table}: {e}")
+        raise e
+
+    logger.info(f"Working set {table} ({p_uf or 'todas as UFs'}): {rows} linhas em {time.perf_counter() - start:.1f}s")
+
+
+def materialize_elegiveis(wdt_ini: str, wdt_fim: str, source: str = 'siscof.vw_tbl_file') -> None:
+    """
+    Calcula, uma única vez para o período e todas as UFs, os grupos (uf, loja, psp, tipo_pessoa)
+    que compõem o 1100: pessoa jurídica sempre, pessoa física apenas quando atinge
+    PF_VALOR_MINIMO e PF_QTD_MINIMA. As consultas J* filtram as lojas da UF por essa tabela.
+    """
+    conn, cur = db.current().conn, db.current().cur
+    start = time.perf_counter()
+
+    try:
+        cur.execute(f"DROP TABLE IF EXISTS {ELEGIVEIS_TABLE}")
+        cur.execute(f"""
+            CREATE UNLOGGED TABLE {ELEGIVEIS_TABLE} AS
+            SELECT vw.uf, vw.loja, vw.psp, vw.tipo_pessoa
+              FROM {source} vw
+             INNER JOIN siscof.dimp_pos_temp AS dpt ON vw.terminal = dpt.terminal
+             WHERE vw.data_operacao >= to_date(%(wdt_ini)s,'yyyymmdd')
+               AND vw.data_operacao <= to_date(%(wdt_fim)s,'yyyymmdd')
+               AND vw.tipo_pessoa IN ('J', 'F')
+             GROUP BY vw.uf, vw.loja, vw.psp, vw.tipo_pessoa
+            HAVING vw.tipo_pessoa = 'J'
+                OR (Sum(vw.valor_operacao) >= %(valor_minimo)s AND Count(1) >= %(qtd_minima)s)
+        """, {'wdt_ini': wdt_ini, 'wdt_fim': wdt_fim, 'valor_minimo': PF_VALOR_MINIMO, 'qtd_minima': PF_QTD_MINIMA})
+        rows = cur.rowcount
+        cur.execute(f"CREATE INDEX ON {ELEGIVEIS_TABLE} (uf, loja)")
+        cur.execute(f"ANALYZE {ELEGIVEIS_TABLE}")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Falha ao calcular {ELEGIVEIS_TABLE}: {e}")
+        raise e
+
+    logger.info(f"Elegíveis do período: {rows} grupos (uf, loja, psp, tipo_pessoa) em {time.perf_counter() - start:.1f}s")
+
+
+def drop_working_set(table: str) -> None:
+    session = db.current()
+    # as leituras no read_conn (J1100, J1115Stream, J0100Index, shards_uf) seguram AccessShareLock na tabela até o
+    # fim da sua transação: sem encerrá-la, o DROP na conexão de escrita esperaria pelo lock da própria sessão
+    if session.read_conn is not session.conn:
+        session.read_conn.rollback()
+    conn, cur = session.conn, session.cur
+    cur.execute(f"DROP TABLE IF EXISTS {table}")
     conn.commit()
 
 
 def j1001_create_line(dinfo: DimpInfo) -> None:
     line = '|1001|1|'
     wreg = '1001'
-    InsertHandler(
-        table_name='tabela_dimp1100',
-        schema='siscof',
-        values=[(1, dinfo.v_nome_arquivo, dinfo.wbloco, wreg, str(dinfo.dt_fim)[6:8], str(dinfo.dt_fim)[4:6],
-                 str(dinfo.dt_fim)[0:4], dinfo.wqtd_lin_1, line, dinfo.p_cod_estado)]
-    ).run_insert()
+    dinfo.writer.add(
+        'tabela_dimp1100',
+        (1, dinfo.v_nome_arquivo, dinfo.wbloco, wreg, str(dinfo.dt_fim)[6:8], str(dinfo.dt_fim)[4:6],
+         str(dinfo.dt_fim)[0:4], dinfo.wqtd_lin_1, line, dinfo.p_cod_estado, dinfo.wloja)
+    )
 
 
 def j0300_create_line(j0100: J0100Child, dinfo: DimpInfo) -> None:
-    line = f"|0300|{j0100['cod_estab']}-IP|{j0100['cnpj']}|{j0100['n_fant']}|{j0100['ende']}|{j0100['cep']}" \
-           f"|{j0100['cod_mun']}|{j0100['uf']}|{j0100['nome_resp']}|{j0100['fone_cont']}|{j0100['email_cont']}|"
+    line = j0100.linha_0300
     wreg = line[1:5]
-    InsertHandler(
-        table_name='tabela_dimp0300',
-        schema='siscof',
-        values=[(1, dinfo.v_nome_arquivo, dinfo.wbloco, wreg, str(dinfo.dt_fim)[6:8], str(dinfo.dt_fim)[4:6],
-                 str(dinfo.dt_fim)[0:4], dinfo.wqtd_lin_0, line, dinfo.p_cod_estado)]
-    ).run_insert()
+    dinfo.writer.add(
+        'tabela_dimp0300',
+        (1, dinfo.v_nome_arquivo, dinfo.wbloco, wreg, str(dinfo.dt_fim)[6:8], str(dinfo.dt_fim)[4:6],
+         str(dinfo.dt_fim)[0:4], dinfo.wqtd_lin_0, line, dinfo.p_cod_estado, dinfo.wloja)
+    )
 
 
 def j1990_create_line(dinfo: DimpInfo) -> None:
     line = f'|1990|{dinfo.wqtd_lin_1 + 1}|'
     wreg = '1990'
-    InsertHandler(
-        table_name='tabela_dimp1100',
-        schema='siscof',
-        values=[
-            (1, dinfo.v_nome_arquivo, dinfo.wbloco, wreg, str(dinfo.dt_fim)[6:8], str(dinfo.dt_fim)[4:6],
-             str(dinfo.dt_fim)[0:4], dinfo.wqtd_lin_1, line, dinfo.p_cod_estado)]
-    ).run_insert()
+    dinfo.writer.add(
+        'tabela_dimp1100',
+        (1, dinfo.v_nome_arquivo, dinfo.wbloco, wreg, str(dinfo.dt_fim)[6:8], str(dinfo.dt_fim)[4:6],
+         str(dinfo.dt_fim)[0:4], dinfo.wqtd_lin_1, line, dinfo.p_cod_estado, dinfo.wloja)
+    )
     # f.write(line + '\n')
 
 
-def gera_dimp_fd(p_instituicao: int, p_cod_estado: int, p_data: int) -> None:
+RUN_STATE_TABLE = 'siscof.dimp_run_state'
+
+
+@dataclass
+class Checkpoint:
+    filhos_1100: int
+    loja: str | None
+    wqtd_lin_0: int
+    wqtd_lin_1: int
+    terminais_0200: list[str]
+    # maior `ordem` de cada tabela de staging no checkpoint (ver staging_ordens); None nos checkpoints antigos
+    ordens: dict[str, int] | None = None
+
+
+class RunState:
+    """
+    Progresso de uma execução em siscof.dimp_run_state, por (run_id, uf, loja): a linha da UF (loja '')
+    guarda o status e o último checkpoint (contadores e terminais 0200 já emitidos) e as demais, as lojas
+    concluídas. A linha da própria execução (uf 0) é gravada e confirmada antes da primeira UF. As gravações usam a conexão de escrita e entram no commit da unidade de trabalho da UF,
+    de modo que o checkpoint salvo corresponde exatamente às linhas confirmadas no staging.
+    """
+
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self._lojas: list[str] = []
+
+    @staticmethod
+    def create_table(cur, conn) -> None:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {RUN_STATE_TABLE} (
+                run_id varchar,
+                uf integer,
+                loja varchar,
+                status varchar,
+                filhos_1100 integer,
+                wqtd_lin_0 integer,
+                wqtd_lin_1 integer,
+                terminais_0200 text[],
+                ordens jsonb,
+                atualizado timestamp DEFAULT now(),
+                PRIMARY KEY (run_id, uf, loja)
+            )""")
+        cur.execute(f"ALTER TABLE {RUN_STATE_TABLE} ADD COLUMN IF NOT EXISTS ordens jsonb")
+        conn.commit()
+
+    @staticmethod
+    def new_run_id(p_data: int) -> str:
+        return f"{p_data}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}"
+
+    def start(self, cur, conn) -> None:
+        """
+        Registra a execução antes de qualquer UF: sem isso, uma execução nova (com o staging recriado) que falhasse
+        antes do primeiro commit de UF não existiria para o --resume, que retomaria uma execução anterior.
+        """
+        cur.execute(
+            f"INSERT INTO {RUN_STATE_TABLE} (run_id, uf, loja, status) VALUES (%s, 0, '', 'INICIADA')"
+            " ON CONFLICT DO NOTHING",
+            (self.run_id,)
+        )
+        conn.commit()
+
+    @staticmethod
+    def last_run(cur, p_data: int) -> str | None:
+        # o run_id termina com o horário de início: a última execução iniciada, mesmo sem UF confirmada
+        cur.execute(
+            f"SELECT max(run_id) run_id FROM {RUN_STATE_TABLE} WHERE run_id LIKE %s",
+            (f'{p_data}_%',)
+        )
+        return cur.fetchone()['run_id']
+
+    def concluidas(self) -> set[int]:
+        cur = db.current().cur
+        cur.execute(
+            f"SELECT uf FROM {RUN_STATE_TABLE} WHERE run_id = %s AND loja = '' AND status = 'CONCLUIDA'",
+            (self.run_id,)
+        )
+        return {int(r['uf']) for r in cur.fetchall()}
+
+    def uf(self, uf: int) -> tuple[str, Checkpoint | None] | None:
+        """
+        Status da UF e o último checkpoint confirmado, ou None se a UF ainda não foi iniciada nesta execução.
+        """
+        cur = db.current().cur
+        cur.execute(
+            f"SELECT status, filhos_1100, wqtd_lin_0, wqtd_lin_1, terminais_0200, ordens FROM {RUN_STATE_TABLE}"
+            " WHERE run_id = %s AND uf = %s AND loja = ''",
+            (self.run_id, uf)
+        )
+        r = cur.fetchone()
+        if r is None:
+            return None
+        if r['filhos_1100'] is None:
+            return r['status'], None
+        return r['status'], Checkpoint(
+            r['filhos_1100'], None, r['wqtd_lin_0'], r['wqtd_lin_1'], list(r['terminais_0200'] or []), r['ordens']
+        )
+
+    def set_status(self, uf: int, status: str, checkpoint: Checkpoint | None = None) -> None:
+        cur = db.current().cur
+        if checkpoint is None:
+            cur.execute(f"""
+                INSERT INTO {RUN_STATE_TABLE} (run_id, uf, loja, status) VALUES (%s, %s, '', %s)
+                ON CONFLICT (run_id, uf, loja) DO UPDATE SET status = EXCLUDED.status, atualizado = now()
+            """, (self.run_id, uf, status))
+        else:
+            cur.execute(f"""
+                INSERT INTO {RUN_STATE_TABLE}
+                    (run_id, uf, loja, status, filhos_1100, wqtd_lin_0, wqtd_lin_1, terminais_0200, ordens)
+                VALUES (%s, %s, '', %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (run_id, uf, loja) DO UPDATE SET
+                    status = EXCLUDED.status, filhos_1100 = EXCLUDED.filhos_1100, wqtd_lin_0 = EXCLUDED.wqtd_lin_0,
+                    wqtd_lin_1 = EXCLUDED.wqtd_lin_1, terminais_0200 = EXCLUDED.terminais_0200,
+                    ordens = EXCLUDED.ordens, atualizado = now()
+            """, (self.run_id, uf, status, checkpoint.filhos_1100, checkpoint.wqtd_lin_0, checkpoint.wqtd_lin_1,
+                  checkpoint.terminais_0200, psycopg2.extras.Json(checkpoint.ordens)))
+            logger.debug(f"Checkpoint da UF {uf}: {checkpoint.filhos_1100} registros 1100, loja {checkpoint.loja}")
+
+        if self._lojas:
+            psycopg2.extras.execute_values(
+                cur,
+                f"INSERT INTO {RUN_STATE_TABLE} (run_id, uf, loja, status) VALUES %s ON CONFLICT DO NOTHING",
+                [(self.run_id, uf, loja, 'CONCLUIDA') for loja in dict.fromkeys(self._lojas)]
+            )
+            self._lojas.clear()
+
+    def loja_done(self, loja: str) -> None:
+        self._lojas.append(loja)
+
+    def discard(self) -> None:
+        self._lojas.clear()
+
+
+FINGERPRINT_TABLE = 'siscof.dimp_fingerprint'
 
+
+class Fingerprints:
+    """
+    Impressão digital das entradas de cada loja da UF no período (quantidade, soma e marca de atualização
+    das transações), gravada em siscof.dimp_fingerprint ao fim de cada geração bem-sucedida da UF.
+    Só a geração incremental a calcula no início, para ler da origem de novo apenas as lojas com impressão
+    diferente da gravada; nas demais ela é calculada uma vez, depois da UF gerada.
+    A marca é o máximo de `config.watermark_column` ou, sem ela, o md5 dos id_transacao da loja.
+    """
+
+    def __init__(self, dimp_info: DimpInfo):
+        self.dinfo = dimp_info
+        self.atual: dict[str, tuple] = {
+            r['loja']: (r['qtde'], r['valor'], r['marca']) for r in self.query.run_select()
+        }
+
+    def anterior(self) -> dict[str, tuple]:
+        cur = db.current().cur
+        cur.execute(
+            f"SELECT loja, qtde, valor, marca FROM {FINGERPRINT_TABLE} WHERE p_data = %s AND uf = %s",
+            (self.dinfo.p_data, self.dinfo.p_cod_estado)
+        )
+        return {r['loja']: (r['qtde'], r['valor'], r['marca']) for r in cur.fetchall()}
+
+    @staticmethod
+    def create_table(cur, conn) -> None:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {FINGERPRINT_TABLE} (
+                p_data integer,
+                uf integer,
+                loja varchar,
+                qtde bigint,
+                valor numeric,
+                marca text,
+                atualizado timestamp DEFAULT now(),
+                PRIMARY KEY (p_data, uf, loja)
+            )""")
+        conn.commit()
+
+    @property
+    def query(self) -> SelectHandler:
+        marca = (
+            f'Max(vw.{config.watermark_column})::text' if config.watermark_column
+            else "md5(string_agg(vw.id_transacao::text, ',' ORDER BY vw.id_transacao))"
+        )
+        return SelectHandler(
+            select_=f'vw.loja, Count(1) QTDE, Sum(vw.valor_operacao) VALOR, {marca} MARCA',
+            from_=f'{self.dinfo.source} vw'
+                  ' inner join siscof.dimp_pos_temp as dpt on vw.terminal = dpt.terminal',
+            where_=[
+                "vw.data_operacao >= to_date(%(wdt_ini)s,'yyyymmdd')",
+                "vw.data_operacao <= to_date(%(wdt_fim)s,'yyyymmdd')",
+                f"vw.loja IN (SELECT u.loja FROM {self.dinfo.source} u WHERE u.uf = %(uf)s"
+                " AND u.data_operacao >= to_date(%(wdt_ini)s,'yyyymmdd')"
+                " AND u.data_operacao <= to_date(%(wdt_fim)s,'yyyymmdd'))"
+            ],
+            group_by='vw.loja',
+            params={'uf': self.dinfo.p_uf, 'wdt_ini': self.dinfo.wdt_ini, 'wdt_fim': self.dinfo.wdt_fim},
+            selection_type='ALL', log_level=config.log_level, readonly=True
+        )
+
+    def alteradas(self) -> set[str]:
+        """
+        Lojas novas, removidas ou com impressão diferente da última geração da UF no período.
+        """
+        anterior = self.anterior()
+        return {
+            loja for loja in self.atual.keys() | anterior.keys()
+            if self.atual.get(loja) != anterior.get(loja)
+        }
+
+    def save(self) -> None:
+        cur = db.current().cur
+        cur.execute(
+            f"DELETE FROM {FINGERPRINT_TABLE} WHERE p_data = %s AND uf = %s",
+            (self.dinfo.p_data, self.dinfo.p_cod_estado)
+        )
+        psycopg2.extras.execute_values(
+            cur,
+            f"INSERT INTO {FINGERPRINT_TABLE} (p_data, uf, loja, qtde, valor, marca) VALUES %s",
+            [(self.dinfo.p_data, self.dinfo.p_cod_estado, loja, *fp) for loja, fp in self.atual.items()]
+        )
+
+
+class Reuso:
+    """
+    Linhas do bloco 1 (1100, 1110 e 1115) das lojas sem alteração, copiadas do staging para uma tabela
+    temporária antes de a UF ser removida, para serem regravadas na nova numeração (ver replay_loja).
+    Lojas sem linhas no staging (por exemplo, gravadas antes da coluna `loja`) são geradas da origem,
+    junto com as alteradas: `lidas` restringe o J1100 e o J1115Stream a essas lojas.
+    """
+
+    def __init__(self, dimp_info: DimpInfo, lojas: set[str], alteradas: set[str]):
+        self.dinfo = dimp_info
+        self.alteradas = alteradas
+        self.linhas_reusadas = 0
+
+        cur = db.current().cur
+        cur.execute("""
+            CREATE TEMP TABLE dimp_reuso ON COMMIT DROP AS
+            SELECT loja, reg, linha, sequencia, ordem FROM siscof.tabela_dimp1100 WHERE uf = %s AND loja = ANY(%s)
+        """, (str(self.dinfo.p_cod_estado), sorted(lojas)))
+        cur.execute("CREATE INDEX ON dimp_reuso (loja, sequencia, ordem)")
+        cur.execute("SELECT DISTINCT loja FROM dimp_reuso")
+        self.lojas: set[str] = {r['loja'] for r in cur.fetchall()}
+        # nunca vazia: as alteradas não estão entre as reaproveitadas
+        self.lidas: list[str] = sorted((lojas | alteradas) - self.lojas)
+
+    def linhas(self, loja: str) -> list[tuple[str, str]]:
+        cur = db.current().cur
+        cur.execute("SELECT reg, linha FROM dimp_reuso WHERE loja = %s ORDER BY sequencia, ordem", (loja,))
+        linhas = [(r['reg'], r['linha']) for r in cur.fetchall()]
+        self.linhas_reusadas += len(linhas)
+        return linhas
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"Geração incremental ({self.dinfo.p_uf}): {len(self.lojas)} lojas reaproveitadas "
+            f"({self.linhas_reusadas} linhas do bloco 1), {len(self.alteradas)} lojas alteradas, "
+            f"{len(self.lidas)} lojas lidas da origem"
+        )
+
+
+def carrega_param_decred() -> dict[str, Any]:
     param_decred_query = SelectHandler(
         log_level='DEBUG',
         selection_type='ONE',
@@ -715,119 +1510,689 @@ def gera_dimp_fd(p_instituicao: int, p_cod_estado: int, p_data: int) -> None:
         from_='siscof.param_decred p',
     )
 
-    param_decred = param_decred_query.run_select()
+    return param_decred_query.run_select()
+
+
+def gera_dimp_fd(
+        p_instituicao: int,
+        p_cod_estado: int,
+        p_data: int,
+        run_state: RunState | None = None,
+        incremental: bool = False
+) -> None:
+
+    param_decred = carrega_param_decred()
 
     d_info = DimpInfo(p_instituicao, p_cod_estado, p_data, param_decred)
+    if config.emit_mode != 'STAGING':
+        d_info.writer = DimpEmitter(audit=staging if config.emit_mode == 'BOTH' else None)
+
+    if config.working_set == 'UF':
+        d_info.source = working_set_table(p_cod_estado)
+        materialize_working_set(d_info.source, d_info.wdt_ini, d_info.wdt_fim, d_info.p_uf)
+    elif config.working_set == 'ALL':
+        d_info.source = working_set_table()
+
+    # retomada por loja apenas quando as linhas ficam no staging (na emissão direta a UF é refeita inteira)
+    state = run_state.uf(p_cod_estado) if run_state else None
+    checkpoint = state[1] if state and config.emit_mode == 'STAGING' else None
+
+    # a impressão das entradas só é calculada antes da geração quando é preciso compará-la (incremental)
+    fingerprints = Fingerprints(d_info) if incremental else None
+    alteradas = fingerprints.alteradas() if fingerprints else set()
+
+    def cleanup() -> None:
+        d_info.writer.discard()
+        if run_state:
+            run_state.discard()
+        # na geração incremental o rollback já devolveu ao staging as linhas da geração anterior
+        if not incremental:
+            state = run_state.uf(p_cod_estado) if run_state else None
+            delete_uf_rows(p_cod_estado, state[1] if state and config.emit_mode == 'STAGING' else None)
+        if run_state:
+            run_state.set_status(p_cod_estado, 'FALHOU')
+
+    try:
+        # a tabela temporária do Reuso vive até o commit: na geração incremental, um único commit ao fim da UF
+        with db.unit_of_work(f'UF {p_cod_estado}', commit_every=0 if incremental else None, cleanup=cleanup):
+            if incremental and not alteradas:
+                logger.info(
+                    f"UF {p_cod_estado}: nenhuma loja alterada desde a última geração, staging e arquivo mantidos"
+                )
+            else:
+                reuso = None
+                if incremental:
+                    reuso = Reuso(d_info, fingerprints.atual.keys() - alteradas, alteradas)
+                    delete_uf_rows(p_cod_estado)
+                elif state:
+                    # linhas além do último checkpoint confirmado (ou da UF toda, se não há checkpoint)
+                    delete_uf_rows(p_cod_estado, checkpoint)
+                # a montagem anterior da UF na dimp_tabela deixa de valer com o staging gerado de novo
+                delete_dimp_tabela(d_info.p_uf)
+                if checkpoint:
+                    d_info.wqtd_lin_0 = checkpoint.wqtd_lin_0
+                    d_info.wqtd_lin_1 = checkpoint.wqtd_lin_1
+                    d_info.terminais_0200 = set(checkpoint.terminais_0200)
+                    logger.info(f"UF {p_cod_estado}: retomando após {checkpoint.filhos_1100} registros 1100")
+                if run_state:
+                    run_state.set_status(p_cod_estado, 'EM_ANDAMENTO')
+
+                gera_dimp_uf(d_info, run_state, checkpoint, reuso)
+
+                if reuso:
+                    reuso.log_stats()
+                (fingerprints or Fingerprints(d_info)).save()
+
+            if run_state:
+                run_state.set_status(p_cod_estado, 'CONCLUIDA')
+    finally:
+        if config.working_set == 'UF':
+            drop_working_set(d_info.source)
+
+
+def delete_dimp_tabela(p_uf: str | None = None) -> None:
+    """
+    Remove a UF (ou, sem `p_uf`, todas as UFs) da dimp_tabela, para que o `gera_tabela_dimp_fd --resume` monte
+    e exporte a UF de novo a partir do staging desta execução em vez de reaproveitar a montagem anterior.
+    """
+    cur = db.current().cur
+    cur.execute("SELECT to_regclass('siscof.dimp_tabela') IS NOT NULL existe")
+    if not cur.fetchone()['existe']:
+        return
+    if p_uf is None:
+        cur.execute("TRUNCATE siscof.dimp_tabela")
+    else:
+        cur.execute("DELETE FROM siscof.dimp_tabela WHERE uf = %s", (p_uf,))
+
+
+def staging_ordens() -> dict[str, int]:
+    """
+    Último valor da sequência da coluna `ordem` de cada tabela de staging. A sequência é comum às UFs e só cresce:
+    as linhas que a UF gravar depois da leitura têm `ordem` maior, e as gravadas antes, menor ou igual.
+    """
+    cur = db.current().cur
+    ordens = {}
+    for table in STAGING_TABLES:
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'ordem') seq", (f'siscof.{table}',))
+        cur.execute(f"SELECT CASE WHEN is_called THEN last_value ELSE 0 END ordem FROM {cur.fetchone()['seq']}")
+        ordens[table] = cur.fetchone()['ordem']
+    return ordens
+
+
+def delete_uf_rows(p_cod_estado: int, checkpoint: Checkpoint | None = None) -> None:
+    """
+    Remove as linhas da UF do staging; com `checkpoint`, apenas as gravadas depois dele, pela `ordem` gravada no
+    checkpoint. Nos checkpoints sem `ordens`: no bloco 1 as linhas seguintes começam em `wqtd_lin_1`; no bloco 0
+    a segunda linha 0100 do psp 'N' já usa `wqtd_lin_0`, então só as de sequência maior são posteriores.
+    """
+    cur = db.current().cur
+    for table in STAGING_TABLES:
+        if checkpoint is None:
+            cur.execute(f"DELETE FROM siscof.{table} WHERE uf = %s", (str(p_cod_estado),))
+        elif checkpoint.ordens:
+            cur.execute(f"DELETE FROM siscof.{table} WHERE uf = %s AND ordem > %s",
+                        (str(p_cod_estado), checkpoint.ordens[table]))
+        elif table == 'tabela_dimp1100':
+            cur.execute(f"DELETE FROM siscof.{table} WHERE uf = %s AND sequencia >= %s",
+                        (str(p_cod_estado), checkpoint.wqtd_lin_1))
+        else:
+            cur.execute(f"DELETE FROM siscof.{table} WHERE uf = %s AND sequencia > %s",
+                        (str(p_cod_estado), checkpoint.wqtd_lin_0))
+        if cur.rowcount:
+            logger.warning(f"{cur.rowcount} linhas da UF {p_cod_estado} removidas de siscof.{table}")
+
+
+def emit_0100(d_info: DimpInfo, j1100: J1100Child, j0100_index: J0100Index) -> None:
+    for j0100, loopinfo0100 in J0100(d_info, j1100, j0100_index):
+        j0100.create_line()
+        d_info.wqtd_lin_0 += 1
+
+        if j0100['psp'] == 'N':  # == 1
+            j0100.create_line()
+
+
+def emit_0200(d_info: DimpInfo, j1110: J1110Child) -> None:
+    for j0200, _ in J0200(d_info, j1110):
+        j0200.create_line()
+        d_info.wqtd_lin_0 += 1
+
+
+def staging_row(d_info: DimpInfo, wreg: str, sequencia: int, line: str, loja: str | None) -> tuple:
+    return (1, d_info.v_nome_arquivo, d_info.wbloco, wreg, str(d_info.dt_fim)[6:8], str(d_info.dt_fim)[4:6],
+            str(d_info.dt_fim)[0:4], sequencia, line, d_info.p_cod_estado, loja)
+
+
+def replay_loja(d_info: DimpInfo, j1100: J1100Child, j0100_index: J0100Index, linhas: list[tuple[str, str]]) -> None:
+    """
+    Regrava, na numeração atual, as linhas do bloco 1 de uma loja reaproveitada, refazendo os 0100 de cada 1100
+    e os 0200 dos terminais de cada 1110 na mesma ordem da geração a partir da origem.
+    """
+    for wreg, line in linhas:
+        d_info.writer.add('tabela_dimp1100', staging_row(d_info, wreg, d_info.wqtd_lin_1, line, d_info.wloja))
+        d_info.wqtd_lin_1 += 1
+
+        if wreg == '1100':
+            emit_0100(d_info, j1100, j0100_index)
+        elif wreg == '1110':
+            emit_0200(d_info, J1110Child({'cod_mcapt': line.split('|')[2]}, d_info))
+
+
+def gera_lojas(
+        d_info: DimpInfo,
+        j1100_query: J1100,
+        j0100_index: J0100Index,
+        j1115_stream: J1115Stream,
+        run_state: RunState | None = None,
+        checkpoint: Checkpoint | None = None,
+        reuso: Reuso | None = None
+) -> None:
+    """
+    Laço por loja do J1100: 1100, 0100, 1110, 0200 e 1115 de cada loja, na ordem do arquivo.
+    Na geração incremental o J1100 traz só as lojas lidas da origem, e as reaproveitadas são regravadas
+    entre elas, na mesma ordem de loja.
+    """
+    uow = db.current_unit()
+    # sorted em Python ordena como o ORDER BY loja COLLATE "C" do J1100
+    reusadas = iter(sorted(reuso.lojas) if reuso else ())
+    proxima_reusada = next(reusadas, None)
+
+    def loja_concluida(loja: str, filhos_1100: int) -> None:
+        # chamado na troca de loja: o commit e o checkpoint nunca separam os 1100 (um por psp) da mesma loja
+        def flush_checkpoint() -> None:
+            d_info.writer.flush()
+            if run_state and config.emit_mode == 'STAGING':
+                run_state.set_status(d_info.p_cod_estado, 'EM_ANDAMENTO', Checkpoint(
+                    filhos_1100, loja, d_info.wqtd_lin_0, d_info.wqtd_lin_1, sorted(d_info.terminais_0200),
+                    staging_ordens()
+                ))
+
+        if run_state:
+            run_state.loja_done(loja)
+        if uow:
+            uow.loja_done(flush_checkpoint)
+
+    anterior: tuple[str, int] | None = None
+
+    def replay_ate(loja: str | None) -> None:
+        # regrava as lojas reaproveitadas anteriores a `loja` (todas as restantes, sem `loja`)
+        nonlocal anterior, proxima_reusada
+        while proxima_reusada is not None and (loja is None or proxima_reusada < loja):
+            if anterior:
+                loja_concluida(*anterior)
+            # as linhas de uma loja reaproveitada já incluem todos os seus 1100 (um por psp)
+            d_info.wloja = proxima_reusada
+            replay_loja(
+                d_info, J1100Child({'loja': proxima_reusada}, d_info), j0100_index, reuso.linhas(proxima_reusada)
+            )
+            anterior = (proxima_reusada, anterior[1] if anterior else 0)
+            proxima_reusada = next(reusadas, None)
 
-    wtem_transacoes_query = SelectHandler(
-        select_='Sum( l.qtde) wtem_transacoes',
-        from_='(' + (
-                SelectHandler(
-                    debug=True, log_level='DEBUG',
-
-                    select_='vw.loja,count(1) qtde',
-                    from_='siscof.vw_tbl_file vw'
-                          ' inner join siscof.dimp_pos_temp as dpt on vw.terminal = dpt.terminal',
-                    where_=[
-                        # 't.loja = e.loja',
-                        # 't.instituicao = e.instituicao',
-                        "vw.tipo_pessoa = 'F'",
-                        f"vw.data_operacao >= to_date('{d_info.wdt_ini}','yyyymmdd')",
-                        f"vw.data_operacao <= to_date('{d_info.wdt_fim}','yyyymmdd')",
-                        f"vw.uf = '{d_info.p_uf}'"
-                    ],
-                    having_=[
-                        'Sum( valor_operacao ) > 3375',
-                        'Count(1) > 30'
-                    ],
-                    group_by='vw.loja'
-                ).stmt
-                +
-                ' UNION ALL '
-                +
-                SelectHandler(
-                    debug=True, log_level='DEBUG',
-
-                    select_='vw.loja,count(1) qtde',
-                    from_='siscof.vw_tbl_file vw'
-                          ' inner join siscof.dimp_pos_temp as dpt on vw.terminal = dpt.terminal',
-                    where_=[
-                        # f't.instituicao = {p_instituicao}',
-                        # 't.loja = e.loja',
-                        # 't.instituicao = e.instituicao',
-                        "vw.tipo_pessoa = 'J'",
-                        f"vw.data_operacao >= to_date('{d_info.wdt_ini}','yyyymmdd')",
-                        f"vw.data_operacao <= to_date('{d_info.wdt_fim}','yyyymmdd')",
-                        f"vw.uf = '{d_info.p_uf}'"
-
-                    ],
-                    group_by='vw.loja'
-                ).stmt + ') l'
-        ),
-
-        selection_type='ONE', log_level='DEBUG'
-    )
+    for j1100, loopinfo1100 in j1100_query:
+        if checkpoint and loopinfo1100.index < checkpoint.filhos_1100:
+            continue
+        replay_ate(j1100['loja'])
+        if anterior and j1100['loja'] != anterior[0]:
+            loja_concluida(*anterior)
 
-    wtem_transacoes = wtem_transacoes_query.run_select()['wtem_transacoes']
+        d_info.wloja = j1100['loja']
+        j1100.create_line()
+        d_info.wqtd_lin_1 += 1
 
-    with open(f"{config.output_path}/{d_info.v_nome_arquivo}", 'w') as f:
-        if wtem_transacoes and int(wtem_transacoes) > 0:
+        emit_0100(d_info, j1100, j0100_index)
+
+        for j1110, loopinfo1110 in J1110(d_info, j1100):
+            j1110.create_line()
+            d_info.wqtd_lin_1 += 1
 
-            j1001_create_line(d_info)
+            emit_0200(d_info, j1110)
 
-            for j1100, loopinfo1100 in J1100(d_info):
-                j1100.create_line()
+            for j1115, _ in J1115(d_info, j1100, j1110, j1115_stream):
+                j1115.create_line()
                 d_info.wqtd_lin_1 += 1
 
-                for j0100, loopinfo0100 in J0100(d_info, j1100):
-                    j0100.create_line()
-                    d_info.wqtd_lin_0 += 1
+            logger.success(
+                f'Feito: {loopinfo1110.index+1}/{loopinfo1110.len or "?"}'
+                f' --> '
+                f'{loopinfo1100.index+1}/{loopinfo1100.len or "?"}  ({d_info.p_uf})'
+            )
 
-                    if j0100['psp'] == 'N':  # == 1
-                        j0100.create_line()
+        anterior = (j1100['loja'], loopinfo1100.index + 1)
+
+    replay_ate(None)
+    if anterior:
+        loja_concluida(*anterior)
+
+
+class ShardWriter:
+    """
+    Writer dos processos de um shard de lojas (ver gera_shards): guarda (reg, sequencia, linha, loja) de cada
+    linha em um arquivo por tabela, em lotes serializados com pickle, para o processo principal renumerar e gravar.
+    """
+
+    def __init__(self, path: str, batch_size: int | None = None):
+        self.path = path
+        self.batch_size = batch_size or config.staging_batch_size
+        os.makedirs(self.path, exist_ok=True)
+
+        self._buffers: dict[str, list[tuple]] = {}
+        self._files: dict[str, Any] = {}
+        self._rows: dict[str, int] = {}
+
+    def add(self, table_name: str, row: tuple) -> None:
+        buffer = self._buffers.setdefault(table_name, [])
+        buffer.append((row[3], row[7], row[8], row[10]))
+        if len(buffer) >= self.batch_size:
+            self.flush_table(table_name)
+
+    def flush_table(self, table_name: str) -> None:
+        rows = self._buffers.get(table_name)
+        if not rows:
+            return
+        if table_name not in self._files:
+            self._files[table_name] = open(os.path.join(self.path, f'{table_name}.pickle'), 'wb')
+        pickle.dump(rows, self._files[table_name], pickle.HIGHEST_PROTOCOL)
+        self._rows[table_name] = self._rows.get(table_name, 0) + len(rows)
+        rows.clear()
+
+    def flush(self) -> None:
+        for table_name in list(self._buffers):
+            self.flush_table(table_name)
+
+    def discard(self) -> None:
+        for rows in self._buffers.values():
+            rows.clear()
+
+    def log_stats(self) -> None:
+        logger.info(f"Shard {self.path}: {dict(sorted(self._rows.items()))}")
+
+    def close(self) -> None:
+        self.flush()
+        for f in self._files.values():
+            f.close()
+
+    @staticmethod
+    def read(path: str, table_name: str) -> Iterator[tuple[str, int, str, str | None]]:
+        file_path = os.path.join(path, f'{table_name}.pickle')
+        if not os.path.exists(file_path):
+            return
+        with open(file_path, 'rb') as f:
+            while True:
+                try:
+                    rows = pickle.load(f)
+                except EOFError:
+                    return
+                yield from rows
+
+
+class ShardResult(NamedTuple):
+    path: str
+    wqtd_lin_0: int
+    wqtd_lin_1: int
+    terminais_0200: list[str]
+    seconds: float
+
+
+def shards_uf(d_info: DimpInfo, shards: int) -> list[list[str]] | None:
+    """
+    Divide as lojas elegíveis da UF, na ordem do J1100 (collation C), em até `shards` faixas contíguas com volume de transações
+    parecido. None quando a UF tem menos de `config.shard_min_transacoes` transações (geração serial).
+    """
+    qtde = [
+        (r['loja'], int(r['qtde']))
+        for r in SelectHandler(
+            select_='e.loja, count(vw.loja) qtde',
+            from_=f'(SELECT DISTINCT loja FROM {ELEGIVEIS_TABLE} WHERE uf = %(uf)s) e'
+                  f' left join {d_info.source} vw on vw.loja = e.loja'
+                  " and vw.data_operacao >= to_date(%(wdt_ini)s,'yyyymmdd')"
+                  " and vw.data_operacao <= to_date(%(wdt_fim)s,'yyyymmdd')",
+            group_by='e.loja',
+            order_by='e.loja COLLATE "C"',
+            params={'uf': d_info.p_uf, 'wdt_ini': d_info.wdt_ini, 'wdt_fim': d_info.wdt_fim},
+            selection_type='ALL', log_level=config.log_level, readonly=True
+        ).run_select()
+    ]
+    total = sum(q for _, q in qtde)
+    if total < config.shard_min_transacoes:
+        return None
+
+    faixas, atual, acumulado = [], [], 0
+    for loja, q in qtde:
+        atual.append(loja)
+        acumulado += q
+        if len(faixas) < shards - 1 and acumulado >= total * (len(faixas) + 1) / shards:
+            faixas.append(atual)
+            atual = []
+    if atual:
+        faixas.append(atual)
+
+    logger.info(f"UF {d_info.p_uf}: {total} transações em {len(faixas)} shards de {[len(f) for f in faixas]} lojas")
+    return faixas
+
+
+def gera_shard(
+        p_instituicao: int,
+        p_cod_estado: int,
+        p_data: int,
+        pdecred: dict[str, Any],
+        source: str,
+        lojas: list[str],
+        path: str
+) -> ShardResult:
+    """
+    Gera, em um processo do pool, as linhas das lojas de um shard com contadores locais (bloco 0 a partir de 0,
+    bloco 1 a partir de 1) e 0200 apenas dos terminais vistos pela primeira vez no shard.
+    """
+    start = time.perf_counter()
+    writer = ShardWriter(path)
+    with db.session():
+        d_info = DimpInfo(p_instituicao, p_cod_estado, p_data, pdecred, writer)
+        d_info.source = source
+        with db.unit_of_work(f'UF {p_cod_estado} shard {os.path.basename(path)}'):
+            j1100_query = J1100(d_info, lojas)
+            j0100_index = J0100Index(d_info, lojas)
+            j1115_stream = J1115Stream(d_info, lojas=lojas)
+
+            gera_lojas(d_info, j1100_query, j0100_index, j1115_stream)
+
+            j1115_stream.close()
+            j0100_index.log_stats()
+    writer.close()
+    writer.log_stats()
+    return ShardResult(
+        path, d_info.wqtd_lin_0, d_info.wqtd_lin_1, sorted(d_info.terminais_0200), time.perf_counter() - start
+    )
 
-                for j1110, loopinfo1110 in J1110(d_info, j1100):
-                    j1110.create_line()
-                    d_info.wqtd_lin_1 += 1
 
-                    for j0200, _ in J0200(d_info, j1110):
-                        j0200.create_line()
-                        d_info.wqtd_lin_0 += 1
+def merge_shards(d_info: DimpInfo, results: list[ShardResult]) -> None:
+    """
+    Grava as linhas dos shards, na ordem das lojas, com a numeração da geração serial: o bloco 1 de cada shard
+    é deslocado pelas linhas dos anteriores e, no bloco 0, os 0200 de terminais já emitidos por um shard anterior
+    são descartados e as linhas seguintes do shard sobem uma posição por descarte.
+    """
+    start = time.perf_counter()
+    for result in results:
+        descartadas = [
+            sequencia for _, sequencia, line, _ in ShardWriter.read(result.path, 'tabela_dimp0200')
+            if line.split('|')[2].rstrip() in d_info.terminais_0200
+        ]
+        base_0, base_1 = d_info.wqtd_lin_0, d_info.wqtd_lin_1 - 1
+
+        for table_name in ('tabela_dimp0100', 'tabela_dimp0200', 'tabela_dimp0300'):
+            for wreg, sequencia, line, loja in ShardWriter.read(result.path, table_name):
+                if table_name == 'tabela_dimp0200' and line.split('|')[2].rstrip() in d_info.terminais_0200:
+                    continue
+                sequencia = base_0 + sequencia - bisect.bisect_left(descartadas, sequencia)
+                d_info.writer.add(table_name, staging_row(d_info, wreg, sequencia, line, loja))
+
+        for wreg, sequencia, line, loja in ShardWriter.read(result.path, 'tabela_dimp1100'):
+            d_info.writer.add('tabela_dimp1100', staging_row(d_info, wreg, base_1 + sequencia, line, loja))
+
+        d_info.wqtd_lin_0 = base_0 + result.wqtd_lin_0 - len(descartadas)
+        d_info.wqtd_lin_1 = base_1 + result.wqtd_lin_1
+        d_info.terminais_0200.update(result.terminais_0200)
+
+    logger.info(
+        f"UF {d_info.p_uf}: {len(results)} shards juntados em {time.perf_counter() - start:.1f}s "
+        f"(geração dos shards: {', '.join(f'{r.seconds:.1f}s' for r in results)})"
+    )
 
-                    for j1115, _ in J1115(d_info, j1100, j1110):
-                        j1115.create_line()
-                        d_info.wqtd_lin_1 += 1
 
-                    logger.success(
-                        f'Feito: {loopinfo1110.index+1}/{loopinfo1110.len}'
-                        f' --> '
-                        f'{loopinfo1100.index+1}/{loopinfo1100.len}  ({d_info.p_uf})'
-                    )
+def gera_shards(d_info: DimpInfo, faixas: list[list[str]]) -> None:
+    """
+    Gera as faixas de lojas da UF em paralelo, em processos novos (spawn: sem herdar as conexões abertas),
+    e junta o resultado com merge_shards.
+    """
+    pasta = tempfile.mkdtemp(prefix=f'dimp_{d_info.p_uf}_')
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=len(faixas),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker
+        ) as pool:
+            futures = [
+                pool.submit(
+                    gera_shard, d_info.p_instituicao, d_info.p_cod_estado, d_info.p_data, dict(d_info.pdecred),
+                    d_info.source, lojas, os.path.join(pasta, str(i))
+                )
+                for i, lojas in enumerate(faixas)
+            ]
+            results = [future.result() for future in futures]
 
-            j1990_create_line(d_info)
+        merge_shards(d_info, results)
+    finally:
+        shutil.rmtree(pasta, ignore_errors=True)
 
 
-if __name__ == '__main__':
-    tables = ["tabela_dimp1100", "tabela_dimp0100", "tabela_dimp0300", "tabela_dimp0200"]
+def gera_dimp_uf(
+        d_info: DimpInfo,
+        run_state: RunState | None = None,
+        checkpoint: Checkpoint | None = None,
+        reuso: Reuso | None = None,
+        shards: int | None = None
+) -> None:
 
-    for table in tables:
-        create_drop_table(cur, conn, table)
+    # shards de lojas apenas em uma geração completa da UF (sem checkpoint de retomada nem reaproveitamento)
+    shards = config.shard_workers if shards is None else shards
+    faixas = shards_uf(d_info, shards) if shards > 1 and checkpoint is None and reuso is None else None
 
-    cur.execute('select cod_empresa, uf_dimp, dt_dimp_ini, dt_dimp_fim from siscof.param_decred')
-    param_decred = cur.fetchall()[0]
+    with open(f"{config.output_path}/{d_info.v_nome_arquivo}", 'w') as f:
+        if faixas is not None:
+            if faixas:
+                j1001_create_line(d_info)
+                gera_shards(d_info, faixas)
+                j1990_create_line(d_info)
+        else:
+            # na geração incremental, a agregação do J1100 e o fluxo do 1115 ficam nas lojas lidas da origem
+            lidas = reuso.lidas if reuso else None
+            j1100_query = J1100(d_info, lidas)
+            if j1100_query.tem_transacoes or reuso and reuso.lojas:
+
+                if checkpoint is None:
+                    j1001_create_line(d_info)
+                j0100_index = J0100Index(d_info)
+                j1115_stream = J1115Stream(d_info, lojas=lidas)
+
+                gera_lojas(d_info, j1100_query, j0100_index, j1115_stream, run_state, checkpoint, reuso)
+
+                j1115_stream.close()
+                j0100_index.log_stats()
+                d_info.wloja = None
+                j1990_create_line(d_info)
+
+    # o gera_tabela_dimp_fd só emite as UFs do Brasil
+    if isinstance(d_info.writer, DimpEmitter) and int(d_info.pais) == 76:
+        d_info.writer.write(
+            f"{config.output_path}/{d_info.v_nome_arquivo}",
+            d_info.pdecred, d_info.p_uf, d_info.wdt_ini, d_info.wdt_fim
+        )
+
+    d_info.writer.flush()
+    d_info.writer.log_stats()
+    if isinstance(d_info.writer, DimpEmitter):
+        d_info.writer.close()
+
+
+def ufs_por_volume(ufs_cod: list[int], p_data: int) -> list[int]:
+    """
+    Ordena as UFs pela quantidade de transações no período, da maior para a menor.
+    """
+    dt_ini, dt_fim = periodo(p_data)
+
+    qtde = {
+        int(r['cod_estado']): int(r['qtde'])
+        for r in SelectHandler(
+            select_='e.cod_estado, count(vw.uf) qtde',
+            from_='siscof.estado e'
+                  ' left join siscof.vw_tbl_file vw on vw.uf = substr(e.simbolo,1,2)'
+                  f" and vw.data_operacao >= to_date('{dt_ini}','yyyymmdd')"
+                  f" and vw.data_operacao <= to_date('{dt_fim}','yyyymmdd')",
+            group_by='e.cod_estado',
+            selection_type='ALL', log_level=config.log_level, readonly=True
+        ).run_select()
+    }
+    logger.info(f"Transações por UF: {qtde}")
+    return sorted(ufs_cod, key=lambda uf: qtde.get(uf, 0), reverse=True)
+
+
+def run_uf(
+        p_instituicao: int,
+        p_cod_estado: int,
+        p_data: int,
+        run_id: str | None = None,
+        incremental: bool = False
+) -> float:
+    start = time.perf_counter()
+    run_state = RunState(run_id) if run_id else None
+    for tentativa in range(config.uf_retries + 1):
+        try:
+            with db.session():
+                gera_dimp_fd(
+                    p_instituicao=p_instituicao, p_cod_estado=p_cod_estado, p_data=p_data,
+                    run_state=run_state, incremental=incremental
+                )
+            break
+        except Exception as e:
+            if tentativa == config.uf_retries:
+                raise e
+            logger.warning(f"UF {p_cod_estado}: tentativa {tentativa + 1} falhou, gerando a UF novamente ({e})")
+    seconds = time.perf_counter() - start
+    logger.success(f"UF {p_cod_estado} gerada em {seconds:.1f}s")
+    db.provider().log_stats()
+    return seconds
+
+
+def init_worker() -> None:
+    # cada processo do pool abre o seu próprio pool de conexões na primeira sessão
+    config_logger()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Gera as tabelas tabela_dimp* por UF')
+    parser.add_argument('--workers', type=int, default=1, help='quantidade de UFs geradas em paralelo')
+    modo = parser.add_mutually_exclusive_group()
+    modo.add_argument('--resume', action='store_true',
+                      help='retoma a última execução do período, pulando as UFs e lojas já concluídas')
+    modo.add_argument('--incremental', action='store_true',
+                      help='mantém o staging e gera de novo apenas as lojas alteradas desde a última geração')
+    args = parser.parse_args()
+
+    config_logger()
+    log_config_options()
+
+    if args.incremental and config.emit_mode != 'STAGING':
+        logger.error('--incremental reaproveita as linhas das tabelas tabela_dimp* e exige emit_mode STAGING')
+        return
+
+    with db.session() as session:
+        log_diagnostics()
+
+        session.cur.execute('select cod_empresa, uf_dimp, dt_dimp_ini, dt_dimp_fim from siscof.param_decred')
+        param_decred = session.cur.fetchall()[0]
+
+        session.cur.execute("select cod_estado from siscof.estado")
+        ufs_cod = pd.DataFrame(session.cur.fetchall())['cod_estado'].to_list()
+        ufs_cod = sorted(set(ufs_cod))
+
+        RunState.create_table(session.cur, session.conn)
+        Fingerprints.create_table(session.cur, session.conn)
+        # também sem o cache: as execuções sem ele medem a referência da economia (ver J0100Index)
+        J0100Index.create_cache_table(session.cur, session.conn)
+        run_id = RunState.last_run(session.cur, param_decred['dt_dimp_ini']) if args.resume else None
+
+        if run_id:
+            concluidas = RunState(run_id).concluidas()
+            ufs_cod = [uf for uf in ufs_cod if int(uf) not in concluidas]
+            logger.info(f"Retomando a execução {run_id}: {len(concluidas)} UFs concluídas, {len(ufs_cod)} a gerar")
+        else:
+            if args.resume:
+                logger.warning('Nenhuma execução anterior do período para retomar, iniciando uma nova')
+            run_id = RunState.new_run_id(param_decred['dt_dimp_ini'])
+            # registrada antes de a dimp_tabela e o staging da execução anterior serem descartados
+            RunState(run_id).start(session.cur, session.conn)
+            if not args.incremental:
+                # a dimp_tabela só guarda UFs montadas a partir do staging desta execução
+                # (ver gera_tabela_dimp_fd --resume)
+                delete_dimp_tabela()
+                session.conn.commit()
+            for table in STAGING_TABLES:
+                if args.incremental:
+                    session.cur.execute("SELECT to_regclass(%s) IS NOT NULL existe", (f'siscof.{table}',))
+                    if session.cur.fetchone()['existe']:
+                        continue
+                create_drop_table(session.cur, session.conn, table, ufs=[int(uf) for uf in ufs_cod])
+
+        if args.resume or args.incremental:
+            # staging criado antes das colunas loja e ordem (nas linhas já gravadas, a ordem segue a da tabela)
+            for table in STAGING_TABLES:
+                session.cur.execute(f"ALTER TABLE siscof.{table} ADD COLUMN IF NOT EXISTS loja varchar")
+                session.cur.execute(f"ALTER TABLE siscof.{table} ADD COLUMN IF NOT EXISTS ordem bigserial")
+            session.conn.commit()
+        logger.info(f"run_id: {run_id}")
+
+        if param_decred['dt_dimp_ini'] and args.workers > 1:
+            ufs_cod = ufs_por_volume([int(uf) for uf in ufs_cod], param_decred['dt_dimp_ini'])
+
+        if param_decred['dt_dimp_ini'] and config.working_set == 'ALL':
+            materialize_working_set(working_set_table(), *periodo(param_decred['dt_dimp_ini']))
+
+        if param_decred['dt_dimp_ini']:
+            materialize_elegiveis(
+                *periodo(param_decred['dt_dimp_ini']),
+                source=working_set_table() if config.working_set == 'ALL' else 'siscof.vw_tbl_file'
+            )
 
-    cur.execute("select cod_estado from siscof.estado")
-    ufs_cod = pd.DataFrame(cur.fetchall())['cod_estado'].to_list()
-    ufs_cod = sorted(set(ufs_cod))
+    atexit.register(staging.close)
+    falhas = []
 
     if param_decred['dt_dimp_ini']:
 
-        for uf in ufs_cod:
-
-            gera_dimp_fd(
-                p_instituicao=param_decred['cod_empresa'],
-                p_cod_estado=int(uf),
-                p_data=param_decred['dt_dimp_ini']
-            )
+        if args.workers > 1:
+            # os processos filhos não podem herdar as conexões do processo principal
+            db.close_provider()
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as pool:
+                futures = {
+                    pool.submit(
+                        run_uf, param_decred['cod_empresa'], int(uf), param_decred['dt_dimp_ini'], run_id,
+                        args.incremental
+                    ): uf
+                    for uf in ufs_cod
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Falha ao gerar a UF {futures[future]}: {e}")
+                        falhas.append(futures[future])
+        else:
+            for uf in ufs_cod:
+
+                run_uf(
+                    p_instituicao=param_decred['cod_empresa'],
+                    p_cod_estado=int(uf),
+                    p_data=param_decred['dt_dimp_ini'],
+                    run_id=run_id,
+                    incremental=args.incremental
+                )
     else:
         logger.error('Não há data de início de DIMP definida')
+
+    if config.staging_layout == 'PARTITIONED' and config.emit_mode != 'DIRECT':
+        with db.session() as session:
+            for table in STAGING_TABLES:
+                index_staging_table(session.cur, session.conn, table)
+
+    if config.working_set == 'ALL':
+        with db.session():
+            drop_working_set(working_set_table())
+
+    db.close_provider()
+
+    # como na geração serial, uma UF que falhou interrompe o gera_dimp antes da montagem da dimp_tabela
+    if falhas:
+        logger.error(f"UFs não geradas: {sorted(falhas)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,18 @@
+import argparse
 import contextlib
 import datetime
 import os.path
 import sys
-from itertools import combinations
-from typing import Literal
+import time
 
 import pandas as pd
 import psycopg2
 import psycopg2.extras
 from loguru import logger
-from pypika import Query, Table, Field, Order
 import config
+import db
+from db import SelectHandler
+from arquivo_dimp import clean_line, linhas_abertura, linhas_bloco9, linhas_sem_transacoes
 
 
 def config_logger() -> None:
@@ -25,222 +27,127 @@ def log_config_options() -> None:
     logger.info(f"config.log_path: {config.log_path}")
 
 
-config_logger()
-log_config_options()
-
-conn = psycopg2.connect(
-    **config.DB_URL
-)
-logger.success(f"connection: {conn.dsn}")
-cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-# tables = inspector.get_table_names()
-# logger.debug(f"Tables: {tables}")
-
-cur.execute("SELECT * FROM siscof.param_decred")
-param_decred = pd.DataFrame(cur.fetchall())
-logger.debug(f"param_decred:\n{param_decred.to_markdown()}\n{param_decred.to_dict()}")
-
-# cur.execute("SELECT * FROM siscof.vw_tbl_file")
-# vw_tbl_file = pd.DataFrame(cur.fetchall())
+def debug_enabled() -> bool:
+    return config.log_level in ('DEBUG', 'TRACE')
 
 
 def log_table_data(table_name: str) -> None:
+    if not debug_enabled():
+        return
+    cur = db.current().cur
     cur.execute(f"SELECT * FROM siscof.{table_name}")
     table = pd.DataFrame(cur.fetchall())
     logger.debug(f"{table_name}:\n{table.to_markdown()}\n{table.to_dict()}")
 
 
-#f = open("test_table.csv", "w")
-#cur.copy_expert("COPY siscof.tabela_dimp1100 TO STDOUT WITH CSV HEADER", f)
-
-log_table_data('param_decred')
-log_table_data('estado')
-#log_table_data('tabela_dimp1100')
-log_table_data('tabela_dimp0100')
-log_table_data('tabela_dimp0300')
-#log_table_data('tabela_dimp0200')
-
-
-class SelectHandler:
-
-    def __init__(
-            self,
-            select_: str,
-            from_: str,
-            where_: list[str] | None = None,
-            limit_: int | None = None,
-            group_by: str | None = None,
-            having_: list[str] | None = None,
-            order_by: str | None = None,
-            debug: bool = False,
-            selection_type: Literal['ALL', 'ONE'] = 'ALL',
-            log_level='DEBUG'
-    ):
-
-        self.stmt_select = select_
-        self.stmt_from = from_
-        self.stmt_limit = limit_
-        self.stmt_where_cndts = where_ or []
-        self.stmt_having_cndts = having_ or []
-        self.stmt_group_by = group_by
-        self.stmt_order_by = order_by
-
-        self.debug = debug
-        self.selection_type = selection_type
-        self.log_level = log_level
-
-        if debug:
-            self.run_select(log_level=log_level)
-
-    def make_where_having_stmt(self, where_cndts: list[str] | None = None, having_cndts: list[str] | None = None):
-        return (
-                'SELECT ' + self.stmt_select
-                +
-                '\nFROM ' + self.stmt_from
-                +
-                (str(f'\nWHERE ' + '\t\nAND '.join(where_cndts))
-                 if where_cndts else '')
-                +
-                (str('\nGROUP BY ' + self.stmt_group_by)
-                 if self.stmt_group_by else '')
-                +
-                (str('\nHAVING ' + '\tAND '.join(having_cndts))
-                 if having_cndts else '')
-                +
-                (str('\nORDER BY ' + self.stmt_order_by)
-                 if self.stmt_order_by else '')
-                +
-                (str('\nLIMIT ' + str(self.stmt_limit))
-                 if self.stmt_limit else '')
-        )
+def log_diagnostics() -> None:
+    #f = open("test_table.csv", "w")
+    #cur.copy_expert("COPY siscof.tabela_dimp1100 TO STDOUT WITH CSV HEADER", f)
 
-    @property
-    def stmt(self):
-        return self.make_where_having_stmt(self.stmt_where_cndts, self.stmt_having_cndts)
-
-    def gen_tests_stmts(self):
-        stmts = list[str]()
-
-        stmts.append(self.make_where_having_stmt([], []))
-        for r in range(len(self.stmt_where_cndts)):
-            for i in combinations(self.stmt_where_cndts, r):
-                stmts.append(self.make_where_having_stmt(list(i), self.stmt_having_cndts))
-        for r in range(len(self.stmt_having_cndts)):
-            for i in combinations(self.stmt_having_cndts, r):
-                stmts.append(self.make_where_having_stmt(self.stmt_where_cndts, list(i)))
-        return stmts
-
-    def __run_tests__(self):
-        if len(self.stmt_where_cndts) + len(self.stmt_having_cndts) == 0:
-            logger.opt(depth=1).error("Não há condições para testar")
-        for stmt in self.gen_tests_stmts():
-            cur.execute(stmt)
-            r = cur.fetchall()
-            logger.opt(depth=2).trace(f"Query executada:\n{stmt}\n{'-' * 30}\n{pd.DataFrame(r).to_markdown()}")
-
-    def run_select(self, selection_type: Literal["ONE", "ALL"] = None, log_level=None) -> list[dict] | dict:
-        log_level = log_level or self.log_level
-        selection_type = selection_type or self.selection_type
-        # print(f"selection_type: {selection_type}")
-
-        if log_level == 'TRACE':
-            self.__run_tests__()
-
-        try:
-            cur.execute(self.stmt)
-            r = cur.fetchall()
-        except Exception as e:
-            logger.opt(depth=1).error(f"Query executada:\n{self.stmt}\n{'-' * 30}\n{e}")
-            raise e
-        else:
-            if r:
-                logger.opt(depth=1).debug(
-                    f"Query executada:\n{self.stmt}\n{'-' * 30}\n{pd.DataFrame(r).to_markdown()}")
-            if not r:
-                logger.opt(depth=1).warning(f"Query sem retorno:\n{self.stmt}\n{'-' * 30}\n")
-
-        if selection_type == 'ALL':
-            return r
-        elif selection_type == 'ONE':
-            return r[0]
-
-
-class InsertHandler:
-    def __init__(self, table_name: str, schema: str, values: list[tuple]):
-        self.table_name = table_name
-        self.schema = schema
-        self.values = values
-
-    @property
-    def stmt(self) -> str:
-        return str(Table(self.table_name, schema=self.schema).insert(*self.values))
-
-    def run_insert(self):
-        try:
-            cur.execute(self.stmt)
-            conn.commit()
-        except Exception as e:
-            logger.opt(depth=1).error(f"Query executada:\n{self.stmt}\n{'-' * 30}\n{e}")
-            raise e
-        else:
-            cur.execute(f"SELECT * FROM {self.schema}.{self.table_name}")
-            r = cur.fetchall()
-            logger.opt(depth=1).debug(f"Query executada:\n{self.stmt}\n{'-' * 30}")#\n{pd.DataFrame(r).to_markdown()}")
+    log_table_data('param_decred')
+    log_table_data('estado')
+    #log_table_data('tabela_dimp1100')
+    log_table_data('tabela_dimp0100')
+    log_table_data('tabela_dimp0300')
+    #log_table_data('tabela_dimp0200')
+
+
+# limpeza das linhas feita no banco, equivalente a arquivo_dimp.clean_line
+CLEAN_LINE_SQL = r"replace(replace(replace(linha, 's\n', 's/n'), 'S\N', 's/n'), '  ', ' ')"
+
+
+def export_file(cur, uf: str, path: str) -> None:
+    """
+    Escreve o arquivo da UF direto do COPY TO STDOUT, em ordem de `sequencia`, sem carregar as linhas em memória.
+    O CSV usa delimitador e aspas (0x1f e 0x1e) que não aparecem nas linhas, que assim saem sem escape.
+    O arquivo é escrito em `path`.tmp e renomeado ao final, para que uma falha não deixe um .txt truncado.
+    """
+    start = time.perf_counter()
+    with open(path + '.tmp', 'w', encoding=config.output_encoding, buffering=config.export_buffer_bytes) as f:
+        cur.copy_expert(
+            cur.mogrify(
+                "COPY (SELECT linha FROM siscof.dimp_tabela WHERE uf = %s ORDER BY sequencia) "
+                "TO STDOUT WITH (FORMAT csv, DELIMITER E'\\x1f', QUOTE E'\\x1e')",
+                (uf,)
+            ).decode(),
+            f
+        )
+    os.replace(path + '.tmp', path)
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(path) / 1024 ** 2
+    logger.success(f'{path}: {size:.1f} MB exportados em {seconds:.2f}s ({size / seconds if seconds else 0:.1f} MB/s)')
 
 
-def gera_tabela_dimp_fd(pdata):
+def gera_tabela_dimp_fd(pdata, resume: bool = False):
     """
     :param pdata: data no formato YYYYMMDD
+    :param resume: mantém a dimp_tabela existente e monta apenas as UFs que ainda não estão nela
+        (as já montadas são apenas exportadas de novo)
     :return:
     """
 
+    conn, cur = db.current().conn, db.current().cur
+
     dt_ini = str(pdata)
     dt_fim = int(str(pd.to_datetime(dt_ini, format='%Y%m%d').to_period('M').end_time)[:10].replace('-', ''))
 
-    wmsg = ''
-
     wdt_ini = str(dt_ini)
     wdt_fim = str(dt_fim)
 
-    wcod_fin = 1
     p_ano = int(str(dt_fim)[:4])
     p_mes = int(str(dt_fim)[4:6])
     p_dia = int(str(dt_fim)[6:8])
     v_nome_arquivo = ''
-    wreg = ''
     wbloco = 0
-    wqtd_lin_0 = 0
-    wqtd_lin_1 = 0
-
-    line = ''
-    linha = 10
     wtem_transacoes = 0
     cont_update = 0
 
-    def insert_table(p_instituicao, uf):
-        nonlocal wreg, line, wqtd_lin_0, cont_update, wtem_transacoes, wmsg
-
-        wreg = line[1:5]
-
-        line = line.replace(r's\n', 's/n').replace(r'S\N', 's/n').replace('  ', ' ')
-
-        InsertHandler(
-            table_name='dimp_tabela',
-            schema='siscof',
-            values=[(p_instituicao, v_nome_arquivo, wbloco, wreg, p_dia, p_mes, p_ano, cont_update, uf, line)]
-        ).run_insert()
+    def insert_lines(lines, p_instituicao, uf) -> int:
+        nonlocal cont_update
 
-        #if cont_update % 10000 == 0:
-        conn.commit()
+        values = []
+        for line in lines:
+            values.append((p_instituicao, v_nome_arquivo, wbloco, line[1:5], p_dia, p_mes, p_ano, cont_update, uf,
+                           clean_line(line)))
+            cont_update += 1
 
-        cont_update += 1
+        psycopg2.extras.execute_values(
+            cur,
+            'INSERT INTO siscof.dimp_tabela '
+            '(instituicao, nome_tabela, bloco, reg, dia, mes, ano, sequencia, uf, linha) VALUES %s',
+            values
+        )
+        return len(values)
+
+    def copy_table(table_name, p_instituicao, uf, cod_estado) -> int:
+        """
+        Copia as linhas da UF de uma tabela tabela_dimp* para dimp_tabela, na ordem de `sequencia`
+        (empates pela coluna `ordem`, a ordem de gravação), numeradas a partir de `cont_update`.
+        """
+        nonlocal cont_update
+
+        start = time.perf_counter()
+        cur.execute(f"""
+            INSERT INTO siscof.dimp_tabela (instituicao, nome_tabela, bloco, reg, dia, mes, ano, sequencia, uf, linha)
+            SELECT %(instituicao)s, %(nome_tabela)s, %(bloco)s, substr(linha, 2, 4), %(dia)s, %(mes)s, %(ano)s,
+                   %(base)s + row_number() OVER (ORDER BY sequencia, ordem) - 1, %(uf)s, {CLEAN_LINE_SQL}
+              FROM siscof.{table_name}
+             WHERE uf = %(cod_estado)s
+             ORDER BY sequencia, ordem
+        """, {
+            'instituicao': p_instituicao, 'nome_tabela': v_nome_arquivo, 'bloco': wbloco,
+            'dia': p_dia, 'mes': p_mes, 'ano': p_ano, 'base': cont_update, 'uf': uf, 'cod_estado': str(cod_estado)
+        })
+        cont_update += cur.rowcount
+        logger.success(f'{cur.rowcount} linhas de {table_name} copiadas em {time.perf_counter() - start:.2f}s. cod_estado {uf}')
+        return cur.rowcount
 
     logger.info('inicio da proc gera_tabela_dimp')
 
-    cur.execute('drop table if exists siscof.dimp_tabela')
+    if not resume:
+        cur.execute('drop table if exists siscof.dimp_tabela')
     cur.execute(f"""
-        CREATE TABLE siscof.dimp_tabela (
+        CREATE TABLE IF NOT EXISTS siscof.dimp_tabela (
         instituicao integer,
         nome_tabela VARCHAR,
         bloco integer,
@@ -252,8 +159,17 @@ def gera_tabela_dimp_fd(pdata):
         uf varchar,
         linha VARCHAR
     );""")
+    cur.execute('CREATE INDEX IF NOT EXISTS dimp_tabela_uf_sequencia_idx ON siscof.dimp_tabela (uf, sequencia)')
     conn.commit()
 
+    # cada UF é montada em uma única transação: as UFs presentes na tabela estão completas
+    cur.execute('SELECT DISTINCT uf FROM siscof.dimp_tabela')
+    concluidas = {r['uf'] for r in cur.fetchall()}
+    cur.execute('SELECT coalesce(max(sequencia) + 1, 0) proxima FROM siscof.dimp_tabela')
+    cont_update = cur.fetchone()['proxima']
+    if resume:
+        logger.info(f'Retomando dimp_tabela: UFs já montadas {sorted(concluidas)}')
+
     for i in SelectHandler(
             log_level=config.log_level,
             select_="""
@@ -286,9 +202,8 @@ def gera_tabela_dimp_fd(pdata):
                     f"pais = 76"
                 ], ).run_select():
 
-            wqtd_lin_0 = 0
-
             cod_estado = int(p['cod_estado'])
+            start = time.perf_counter()
 
             try:
                 v_nome_arquivo = SelectHandler(
@@ -306,9 +221,13 @@ def gera_tabela_dimp_fd(pdata):
             if not v_nome_arquivo:
                 v_nome_arquivo = f"DIMP_{p['uf']}_{wdt_fim}.txt"
 
-            # BLOCO 0 - ABERTURA E IDENTIFICA��������������������O
+            if p['uf'] in concluidas:
+                # o arquivo pode ter ficado incompleto ou sido esvaziado pelo gera_dimp_fd: sempre exportado de novo
+                export_file(cur, p['uf'], f"{config.output_path}/{v_nome_arquivo}")
+                continue
+
+            # BLOCO 0 - ABERTURA E IDENTIFICAÇÃO
             wbloco = 0
-            wcod_fin = 1
 
             wtem_transacoes = SelectHandler(
                 log_level=config.log_level,
@@ -320,249 +239,69 @@ def gera_tabela_dimp_fd(pdata):
 
             # Verifica se existe clientes para esse estado
             logger.info(f'{wtem_transacoes} transações para registrar no estado {p["uf"]}')
-            if wtem_transacoes > 0:
-                # Abertura do Arquivo Digital e Identifica����������������o da Institui����������������o
-                line = f"|0000|09|1|{p['uf']}|{i['empresa_cnpj']}|{i['empresa_nome']}|{wdt_ini}|{wdt_fim}|1|" \
-                       f"{datetime.datetime.now().date().strftime('%Y%m')}|"
-                insert_table(i['instituicao'], p['uf'])
-                wqtd_lin_0 += 1
-
-                # BLOCO 0 - REGISTRO TIPO 0001: ABERTURA DO BLOCO 0
-                line = f"|0001|1|"
-                insert_table(i['instituicao'], p['uf'])
-                wqtd_lin_0 += 1
-
-                # REGISTRO TIPO 0005: DADOS COMPLEMENTARES DA INSTITUI����������������O DE PAGAMENTO
-                line = f"|0005|{i['empresa_nome']}|{i['empresa_endereco']} {i['empresa_numero']} " \
-                       f"{i['empresa_compl']} {i['empresa_bairro']}|{i['empresa_cep']}|{i['empresa_codmun']}|" \
-                       f"{i['empresa_estado']}|{i['responsavel']}|{i['empresa_tel']}|{i['empresa_email']}|"
-
-                insert_table(i['instituicao'], p['uf'])
-                wqtd_lin_0 += 1
-
-                # REGISTRO TIPO 0100: TABELA DE CADASTRO DO CLIENTE
-                logger.info(f'Gerando tabela 0100. cod_estado {p["uf"]}')
-                wreg = '0100'
-                for j in SelectHandler(
-                        log_level=config.log_level,
-                        select_="linha",
-                        from_='siscof.tabela_dimp0100',
-                        where_=[
-                            f"uf = '{cod_estado}'"
-                        ],
-                        order_by='sequencia'
-                ).run_select():
-                    line = j['linha']
-                    insert_table(i['instituicao'], p['uf'])
-                    wqtd_lin_0 += 1
-                logger.success(f'Sucesso ao gerar tabela 0100. cod_estado {p["uf"]}')
-
-                # REGISTRO TIPO 0200: TABELA DE CADASTRO DO MEIO DE CAPTURA
-                logger.info(f'Gerando tabela 0200. cod_estado {p["uf"]}')
-                wreg = '0200'
-                for j in SelectHandler(
-                        log_level=config.log_level,
-                        select_="linha",
-                        from_='siscof.tabela_dimp0200',
-                        where_=[
-                            f"uf = '{cod_estado}'"
-                        ],
-                        group_by='uf, linha',
-                        order_by='max(sequencia)'
-                ).run_select():
-                    line = j['linha']
-                    insert_table(i['instituicao'], p['uf'])
-                    wqtd_lin_0 += 1
-                logger.success(f'Sucesso ao gerar tabela 0200. cod_estado {p["uf"]}')
-
-                # REGISTRO TIPO 0300: DADOS DA INSTITUI����������������O DE PAGAMENTO PARCEIRA
-                logger.info(f'Gerando tabela 0300. cod_estado {p["uf"]}')
-                wreg = '0300'
-                for j in SelectHandler(
-                        log_level=config.log_level,
-                        select_="linha",
-                        from_='siscof.tabela_dimp0300',
-                        where_=[
-                            f"uf = '{cod_estado}'"
-                        ],
-                        order_by='sequencia'
-                ).run_select():
-                    line = j['linha']
-                    insert_table(i['instituicao'], p['uf'])
-                    wqtd_lin_0 += 1
-                logger.success(f'Sucesso ao gerar tabela 0300. cod_estado {p["uf"]}')
-
-                # REGISTRO 0990: ENCERRAMENTO DO BLOCO 0
-                logger.info(f'Gerando tabela 0990. cod_estado {p["uf"]}')
-                wreg = '0990'
-                line = f"|0990|{wqtd_lin_0 + 1}|"
-                insert_table(i['instituicao'], p['uf'])
-                logger.success(f'Sucesso ao gerar tabela 0990. cod_estado {p["uf"]}')
-
-                # BLOCO 1 ��������� OPERA����������������������ES DE PAGAMENTOS
-                wbloco = 1
-                wqtd_lin_1 = 1
-
-                # REGISTRO TIPO 1100: RESUMO MENSAL DAS OPERA����������������������ES DE PAGAMENTO
-                logger.info(f'Gerando tabela 1100. cod_estado {p["uf"]}')
-                for j in SelectHandler(
-                        log_level=config.log_level,
-                        select_="linha, reg",
-                        from_='siscof.tabela_dimp1100',
-                        where_=[
-                            f"uf = '{cod_estado}'"
-                        ],
-                        order_by='sequencia'
-                ).run_select():
-                    wreg = j['reg']
-                    line = j['linha']
-                    insert_table(i['instituicao'], p['uf'])
-                    wqtd_lin_1 += 1
-                logger.success(f'Sucesso ao gerar tabela 1100. cod_estado {p["uf"]}')
-
-                # -------------------------------------------------------------------------------------------------
-                wbloco = 9
-
-                # REGISTRO 9001: ABERTURA DO BLOCO 9
-                logger.info(f'Gerando tabela 9001. cod_estado {p["uf"]}')
-                wreg = '9001'
-                line = f"|9001|1|"
-                insert_table(i['instituicao'], p['uf'])
-                logger.success(f'Sucesso ao gerar tabela 9001. cod_estado {p["uf"]}')
-
-                # REGISTRO TIPO 9900: REGISTROS DO ARQUIVO
-                wreg = '9900'
-                logger.info(f'Gerando tabela 9900. cod_estado {p["uf"]}')
-                line = f"|9900|9990|1|"
-                insert_table(i['instituicao'], p['uf'])
-
-                line = f"|9900|9999|1|"
-                insert_table(i['instituicao'], p['uf'])
-
-                for j in SelectHandler(
-                        log_level=config.log_level,
-                        select_="reg, count(1) qtde",
-                        from_='siscof.dimp_tabela',
-                        where_=[
-                            f"reg <> '9900'",
-                            f"uf = '{p['uf']}'"
-                        ],
-                        group_by='reg',
-                        order_by='reg'
-                ).run_select():
-                    line = f"|9900|{j['reg']}|{j['qtde']}|"
-                    insert_table(i['instituicao'], p['uf'])
-
-                for j in SelectHandler(
-                        log_level=config.log_level,
-                        select_="count(1)+1 qtde",
-                        from_='siscof.dimp_tabela',
-                        where_=[
-                            f"reg = '9900'",
-                            f"uf = '{p['uf']}'"
-                        ],
-                ).run_select():
-                    line = f"|9900|9900|{j['qtde']}|"
-                    insert_table(i['instituicao'], p['uf'])
-
-                # REGISTRO TIPO 9990: ENCERRAMENTO DO BLOCO 9
-
-                for j in SelectHandler(
-                        log_level=config.log_level,
-                        select_="count(1) +3 qtde",
-                        from_='siscof.dimp_tabela',
-                        where_=[
-                            f"reg = '9900'",
-                            f"uf = '{p['uf']}'"
-                        ],
-                ).run_select():
-                    line = f"|9990|{j['qtde']}|"
-                    insert_table(i['instituicao'], p['uf'])
-
-                logger.success(f'Sucesso ao gerar tabela 9900. cod_estado {p["uf"]}')
-
-                # REGISTRO TIPO 9999: ENCERRAMENTO DO ARQUIVO DIGITAL
-                logger.info(f'Gerando tabela 9999. cod_estado {p["uf"]}')
-                wbloco = 9
-
-                for j in SelectHandler(
-                        log_level=config.log_level,
-                        select_="count(1) +1 qtde",
-                        from_='siscof.dimp_tabela',
-                        where_=[
-                            f"uf = '{p['uf']}'"
-                        ],
-                ).run_select():
-                    line = f"|9999|{j['qtde']}|"
-                    insert_table(i['instituicao'], p['uf'])
-
-                logger.success(f'Sucesso ao gerar tabela 9999. cod_estado {p["uf"]}')
-
-                with open(f"{config.output_path}/{v_nome_arquivo}", 'w') as f:
-                    cur.execute(f"select linha from siscof.dimp_tabela where uf='{p['uf']}'")
-
-                    linhas = cur.fetchall()
-                    for linha in linhas:
-                        f.write(f"{linha['linha']}\n")
-            else:
-                linha = 50
-                line = f"|0000|09|4|{p['uf']}|{i['empresa_cnpj']}|{i['empresa_nome']}|{wdt_ini}|{wdt_fim}|1|" \
-                          f"{datetime.datetime.now().date().strftime('%Y%m')}|"
-                insert_table(i['instituicao'], p['uf'])
-
-                wbloco = 0
-                linha = 290
-                line = '|0001|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = f"|0005|{i['empresa_nome']}|{i['empresa_endereco']}|{i['empresa_cep']}|{i['empresa_codmun']}|" \
-                          f"{i['empresa_estado']}|{i['responsavel']}|{i['empresa_tel']}|{i['empresa_email']}|"
-                insert_table(i['instituicao'], p['uf'])
-                line = '|0990|4|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|1001|0|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|1990|2|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9001|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|0000|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|0001|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|0005|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|0990|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|1001|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|1990|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|9001|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|9990|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|9999|1|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9900|9900|10|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9990|13|'
-                insert_table(i['instituicao'], p['uf'])
-                line = '|9999|19|'
-                insert_table(i['instituicao'], p['uf'])
-
-                with open(f"{config.output_path}/{v_nome_arquivo}", 'w') as f:
-                    cur.execute(f"select linha from siscof.dimp_tabela where uf='{p['uf']}'")
-
-                    linhas = cur.fetchall()
-                    for linha in linhas:
-                        f.write(f"{linha['linha']}\n")
+            base = cont_update
+
+            def cleanup() -> None:
+                nonlocal cont_update
+                cur.execute("DELETE FROM siscof.dimp_tabela WHERE uf = %s", (p['uf'],))
+                cont_update = base
+
+            with db.unit_of_work(f'dimp_tabela {p["uf"]}', cleanup=cleanup):
+                if wtem_transacoes > 0:
+                    # Abertura do Arquivo Digital (0000), abertura do bloco 0 (0001) e dados complementares (0005)
+                    wqtd_lin_0 = insert_lines(linhas_abertura(i, p['uf'], wdt_ini, wdt_fim), i['instituicao'], p['uf'])
+
+                    # REGISTROS 0100 (cadastro do cliente), 0200 (meio de captura) e 0300 (instituição parceira)
+                    for table_name in ('tabela_dimp0100', 'tabela_dimp0200', 'tabela_dimp0300'):
+                        wqtd_lin_0 += copy_table(table_name, i['instituicao'], p['uf'], cod_estado)
+
+                    # REGISTRO 0990: ENCERRAMENTO DO BLOCO 0
+                    insert_lines([f"|0990|{wqtd_lin_0 + 1}|"], i['instituicao'], p['uf'])
+
+                    # BLOCO 1 - OPERAÇÕES DE PAGAMENTOS (1001, 1100, 1110, 1115 e 1990)
+                    wbloco = 1
+                    copy_table('tabela_dimp1100', i['instituicao'], p['uf'], cod_estado)
+
+                    # BLOCO 9 - 9001, 9900, 9990 e 9999 a partir da contagem por registro dos blocos 0 e 1
+                    wbloco = 9
+                    cur.execute(
+                        "SELECT reg, count(1) qtde FROM siscof.dimp_tabela WHERE uf = %s GROUP BY reg",
+                        (p['uf'],)
+                    )
+                    contagem = {r['reg']: r['qtde'] for r in cur.fetchall()}
+                    insert_lines(linhas_bloco9(contagem), i['instituicao'], p['uf'])
+                else:
+                    insert_lines(linhas_sem_transacoes(i, p['uf'], wdt_ini, wdt_fim), i['instituicao'], p['uf'])
+            logger.success(f'dimp_tabela montada em {time.perf_counter() - start:.2f}s. cod_estado {p["uf"]}')
+
+            export_file(cur, p['uf'], f"{config.output_path}/{v_nome_arquivo}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Monta a dimp_tabela e os arquivos DIMP a partir das tabelas tabela_dimp*')
+    parser.add_argument('--resume', action='store_true', help='mantém as UFs já montadas na dimp_tabela')
+    args = parser.parse_args()
+
+    config_logger()
+    log_config_options()
+
+    if config.emit_mode == 'DIRECT':
+        logger.error('emit_mode DIRECT: os arquivos já são gerados pelo gera_dimp_fd e as tabelas tabela_dimp* estão vazias')
+        return
+
+    with db.session() as session:
+        log_diagnostics()
+
+        session.cur.execute('select dt_dimp_ini from siscof.param_decred')
+        dt_dimp_ini = session.cur.fetchall()[0]['dt_dimp_ini']
+        if dt_dimp_ini:
+            gera_tabela_dimp_fd(dt_dimp_ini, resume=args.resume)
+        else:
+            logger.error('Data inicial não informada')
+        log_table_data('dimp_tabela')
+
+    db.close_provider()
 
 
 if __name__ == '__main__':
-    cur.execute('select dt_dimp_ini from siscof.param_decred')
-    dt_dimp_ini = cur.fetchall()[0]['dt_dimp_ini']
-    if dt_dimp_ini:
-        gera_tabela_dimp_fd(dt_dimp_ini)
-    else:
-        logger.error('Data inicial não informada')
-    log_table_data('dimp_tabela')
\ No newline at end of file
+    main()
@@ -0,0 +1,178 @@
+"""
+Geração em shards sem banco: as lojas sintéticas passam pelo gera_lojas uma vez em série e uma vez por faixa
+(com ShardWriter), e o merge_shards deve reproduzir linha a linha a numeração da geração serial.
+
+    python -m pytest -q test_merge_shards.py
+"""
+import datetime
+
+import pytest
+
+import gera_dimp_fd as g
+
+DIA = datetime.date(2023, 7, 10)
+DIA2 = datetime.date(2023, 7, 20)
+
+# loja -> (psp dos 1100, terminais com as datas e a quantidade de transações 1115 de cada)
+LOJAS = {
+    'L01': (['S'], {'T1': {DIA: 2}, 'T2': {DIA: 1, DIA2: 1}}),
+    'L02': (['N', 'S'], {'T2': {DIA: 3}}),
+    'L03': (['S'], {'T1': {DIA2: 1}, 'T3': {DIA: 2}}),
+    'L04': (['N'], {'T4': {DIA: 1}, 'T2': {DIA2: 2}}),
+    'L05': (['S'], {'T3': {DIA: 1}, 'T5': {DIA: 1, DIA2: 1}}),
+    'L06': (['N', 'S'], {'T1': {DIA: 1}, 'T6': {DIA2: 2}}),
+}
+
+
+class RecordingWriter:
+    """
+    Writer em memória com (reg, sequencia, linha, loja) de cada linha, na ordem de gravação por tabela.
+    """
+
+    def __init__(self):
+        self.rows: dict[str, list[tuple]] = {}
+
+    def add(self, table_name: str, row: tuple) -> None:
+        self.rows.setdefault(table_name, []).append((row[3], row[7], row[8], row[10]))
+
+
+class Catalogo:
+    def get(self, terminal: str) -> list[str]:
+        return [f'|0200|{terminal}|{terminal}|3|0||']
+
+
+def synthetic(cls, **attrs):
+    # instância sem o __init__, que consulta o banco
+    obj = cls.__new__(cls)
+    obj.__dict__.update(attrs)
+    return obj
+
+
+def dimp_info(writer) -> g.DimpInfo:
+    return synthetic(
+        g.DimpInfo, p_instituicao=1, p_cod_estado=35, p_data=20230701, p_uf='SP',
+        pdecred={'empresa_cnpj': '00000000000100'}, dt_fim=20230731, wdt_ini='20230701', wdt_fim='20230731',
+        v_nome_arquivo='DIMP_SP_20230731.txt', wbloco=1, wqtd_lin_0=0, wqtd_lin_1=1, wloja=None,
+        terminais_0200=set(), writer=writer
+    )
+
+
+def j1100_rows(lojas: list[str]) -> list[dict]:
+    rows = []
+    for loja in lojas:
+        psps, terminais = LOJAS[loja]
+        rows += [
+            {'loja': loja, 'psp': psp, 'cod_mcapt': None, 'dt_op': None, 'nivel': 3, 'valor': 10.5, 'qtd': 30}
+            for psp in psps
+        ]
+        rows += [
+            {'loja': loja, 'psp': None, 'cod_mcapt': terminal, 'dt_op': dia, 'nivel': 0, 'valor': 1.0 * n, 'qtd': n}
+            for terminal, dias in sorted(terminais.items()) for dia, n in sorted(dias.items())
+        ]
+    return rows
+
+
+def j1115_rows(lojas: list[str]) -> list[dict]:
+    return [
+        {'loja': loja, 'terminal': terminal, 'data_operacao': dia, 'nsu': i, 'cod_aut': f'A{i}',
+         'id_transac': f'{loja}{terminal}{dia:%d}{i}', 'ind_split': 0, 'bandeira': 1, 'hora': 120000,
+         'nat_oper': 1, 'geo': None, 'valor': 1.0}
+        for loja in lojas
+        for terminal, dias in sorted(LOJAS[loja][1].items())
+        for dia, n in sorted(dias.items())
+        for i in range(n)
+    ]
+
+
+def gera(d_info: g.DimpInfo, lojas: list[str]) -> None:
+    j1100_query = synthetic(g.J1100, dinfo=d_info, lojas=lojas, _rows=iter(j1100_rows(lojas)))
+    j1100_query._children = j1100_query._lojas()
+    j1100_query._first = next(j1100_query._children, None)
+
+    j0100_index = synthetic(g.J0100Index, dinfo=d_info, lojas=lojas, hits=0, misses=0, _index={
+        loja: [
+            g.J0100Cadastro(psp, f'|0100|{loja}|{psp}|', f'|0300|{loja}-IP|{psp}|')
+            for psp in LOJAS[loja][0]
+        ]
+        for loja in lojas
+    })
+    j1115_stream = synthetic(
+        g.J1115Stream, dinfo=d_info, lojas=lojas, _rows=iter(j1115_rows(lojas)), _pending=None,
+        _loja=None, _ultima=None, _linhas_loja=0, _guardados={}, max_grupo=0, max_guardadas=0
+    )
+
+    g.gera_lojas(d_info, j1100_query, j0100_index, j1115_stream)
+
+
+def serial() -> g.DimpInfo:
+    d_info = dimp_info(RecordingWriter())
+    g.j1001_create_line(d_info)
+    gera(d_info, sorted(LOJAS))
+    # como em gera_dimp_uf, o 1990 não pertence a nenhuma loja
+    d_info.wloja = None
+    g.j1990_create_line(d_info)
+    return d_info
+
+
+def sharded(faixas: list[list[str]], tmp_path) -> g.DimpInfo:
+    results = []
+    for i, lojas in enumerate(faixas):
+        # lotes pequenos: o ShardWriter grava vários pickles por tabela
+        writer = g.ShardWriter(str(tmp_path / str(i)), batch_size=2)
+        shard_info = dimp_info(writer)
+        gera(shard_info, lojas)
+        writer.close()
+        results.append(g.ShardResult(
+            writer.path, shard_info.wqtd_lin_0, shard_info.wqtd_lin_1, sorted(shard_info.terminais_0200), 0.0
+        ))
+
+    d_info = dimp_info(RecordingWriter())
+    g.j1001_create_line(d_info)
+    g.merge_shards(d_info, results)
+    g.j1990_create_line(d_info)
+    return d_info
+
+
+@pytest.fixture(autouse=True)
+def catalogo_0200(monkeypatch):
+    monkeypatch.setattr(g, 'j0200_catalogue', Catalogo)
+
+
+@pytest.mark.parametrize('faixas', [
+    [['L01', 'L02', 'L03', 'L04', 'L05', 'L06']],
+    [['L01', 'L02', 'L03'], ['L04', 'L05', 'L06']],
+    [['L01'], ['L02', 'L03'], ['L04'], ['L05', 'L06']],
+    [['L01', 'L02', 'L03', 'L04', 'L05'], ['L06']],
+])
+def test_merge_shards_igual_a_geracao_serial(faixas, tmp_path):
+    esperado = serial()
+    obtido = sharded(faixas, tmp_path)
+
+    assert obtido.writer.rows == esperado.writer.rows
+    assert (obtido.wqtd_lin_0, obtido.wqtd_lin_1) == (esperado.wqtd_lin_0, esperado.wqtd_lin_1)
+    assert obtido.terminais_0200 == esperado.terminais_0200
+
+
+def test_j1115_por_1100():
+    # os 1115 de cada (terminal, data) saem uma vez por 1100 da loja, inclusive nas lojas com psp 'N' e 'S'
+    linhas_1115 = [line for reg, _, line, _ in serial().writer.rows['tabela_dimp1100'] if reg == '1115']
+    esperado = sum(
+        len(psps) * n for psps, terminais in LOJAS.values() for dias in terminais.values() for n in dias.values()
+    )
+    assert len(linhas_1115) == esperado
+
+
+def test_merge_shards_0200_uma_vez_por_terminal(tmp_path):
+    obtido = sharded([['L01', 'L02'], ['L03', 'L04'], ['L05', 'L06']], tmp_path)
+
+    linhas_0200 = [line for _, _, line, _ in obtido.writer.rows['tabela_dimp0200']]
+    assert sorted(linhas_0200) == sorted(Catalogo().get(t)[0] for t in ('T1', 'T2', 'T3', 'T4', 'T5', 'T6'))
+    # no bloco 0 as linhas seguem numeradas sem buracos nem repetições, exceto o 0100 repetido de psp 'N'
+    sequencias = sorted(
+        sequencia for table in ('tabela_dimp0100', 'tabela_dimp0200')
+        for _, sequencia, _, _ in obtido.writer.rows[table]
+    )
+    # cada 1100 da loja emite os 0100 de todos os seus psp
+    repetidos = sum(len(psps) * psps.count('N') for psps, _ in LOJAS.values())
+    assert len(sequencias) - len(set(sequencias)) == repetidos
+    assert set(sequencias) == set(range(obtido.wqtd_lin_0))